@@ -1,29 +1,104 @@
 # Calendar and event scheduler implementation
+import logging
+import time
 import datetime
 import uuid
 from discord.ext import commands
 import discord
 from apscheduler.jobstores.base import JobLookupError
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from . import data as Data
+from .pagination import Paginator
 
-intents = discord.Intents.default()
-intents.members = True
-intents.message_content = True
+log = logging.getLogger(__name__)
 
-bot = commands.Bot(command_prefix='!',intents=intents)
+# Reminders are sent this long before an event starts
+REMINDER_LEAD = datetime.timedelta(minutes=15)
 
-bot.scheduler = AsyncIOScheduler()
-bot.scheduler.start()
+# The loaded cog; persisted jobs only store plain arguments and find the bot through it
+active_cog = None
+
+async def send_event_reminder(guild_id, channel_id, event_id, event_name):
+    """Job target for event reminders (module level so the job store can reference it)"""
+    if active_cog is None:
+        log.warning("Event reminder for %s dropped: the calendar cog is not loaded", event_id)
+        return
+    await active_cog.send_event_reminder(guild_id, channel_id, event_id, event_name)
 
 class CalendarCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        
+        # !events pages, rebuilt when an event is added or deleted
+        self.pages = Paginator(
+            "📅 Upcoming Events",
+            discord.Color.blue(),
+            self.event_field,
+            footer="Use !delevent [ID] to remove an event"
+        )
+
+    async def cog_load(self):
+        global active_cog
+        active_cog = self
+        self.rehydrate_reminders()
+
+    async def cog_unload(self):
+        global active_cog
+        active_cog = None
+
+    def schedule_reminder(self, event, run_date=None):
+        """Add (or replace) the reminder job for an event"""
+        event_datetime = datetime.datetime.fromisoformat(event["datetime"])
+        self.bot.scheduler.add_job(
+            send_event_reminder,
+            'date',
+            run_date=run_date or event_datetime - REMINDER_LEAD,
+            args=[event.get("guild_id"), event["channel_id"], event["id"], event["name"]],
+            id=f"reminder_{event['id']}",
+            replace_existing=True,
+            # A reminder missed while the bot was offline still goes out if the event has not started yet
+            misfire_grace_time=int(REMINDER_LEAD.total_seconds()),
+            coalesce=True
+        )
+
+    def rehydrate_reminders(self):
+        """Reconcile events.json with the persisted reminder jobs in one pass"""
+        started = time.perf_counter()
+        now = datetime.datetime.now()
+        
+        events = Data.Data.load_data("events")
+        # The scheduler and its job store are shared, only the calendar's own jobs are reconciled
+        jobs = {job.id for job in self.bot.scheduler.get_jobs() if job.id.startswith("reminder_")}
+        wanted = {f"reminder_{event_id}": event for event_id, event in events.items()}
+        
+        # Jobs whose event is gone
+        removed = 0
+        for job_id in jobs - wanted.keys():
+            try:
+                self.bot.scheduler.remove_job(job_id)
+                removed += 1
+            except JobLookupError:
+                pass
+        
+        # Events without a job: schedule the reminder, or send a missed one right away
+        added = 0
+        for job_id, event in wanted.items():
+            if job_id in jobs or event.get("reminded"):
+                continue
+            event_datetime = datetime.datetime.fromisoformat(event["datetime"])
+            if event_datetime <= now:
+                continue
+            reminder_time = event_datetime - REMINDER_LEAD
+            self.schedule_reminder(event, run_date=max(reminder_time, now))
+            added += 1
+        
+        elapsed = time.perf_counter() - started
+        log.info("Event reminders ready in %.3fs: %d events, %d jobs kept, %d added, %d removed",
+                 elapsed, len(events), len(jobs & wanted.keys()), added, removed)
 
     # Event storage
     events_data = {}
 
-    @bot.command(name='addevent')
+    @commands.command(name='addevent')
     async def add_event(self, ctx, name=None, date_str=None, time_str=None, *, description="No description provided"):
         """Add an event to the calendar with an optional reminder"""
         if not all([name, date_str, time_str]):
@@ -54,33 +129,20 @@ class CalendarCog(commands.Cog):
                 "datetime": event_datetime.isoformat(),
                 "creator_id": ctx.author.id,
                 "creator_name": ctx.author.name,
-                "channel_id": ctx.channel.id
+                "channel_id": ctx.channel.id,
+                "guild_id": ctx.guild.id if ctx.guild else None
             }
             
-            # Load existing events
-            events = Data.Data.load_data("events")
-            
-            # Add the new event
-            if not events:
-                events = {}
-            events[event_id] = event
-            
-            # Save updated events
-            Data.Data.save_data(events, "events")
+            # Add the new event and save it
+            Data.Data.update_record("events", event_id, event)
+            self.pages.invalidate()
             
             # Schedule a reminder 15 minutes before
-            reminder_time = event_datetime - datetime.timedelta(minutes=15)
+            reminder_time = event_datetime - REMINDER_LEAD
             now = datetime.datetime.now()
             
             if reminder_time > now:
-                # Schedule the reminder
-                bot.scheduler.add_job(
-                    CalendarCog.send_event_reminder,
-                    'date',
-                    run_date=reminder_time,
-                    args=[ctx.guild.id, ctx.channel.id, event_id, name],
-                    id=f"reminder_{event_id}"
-                )
+                self.schedule_reminder(event)
             
             # Create confirmation embed
             embed = discord.Embed(
@@ -100,13 +162,16 @@ class CalendarCog(commands.Cog):
             await ctx.send("Invalid date or time format. Please use YYYY-MM-DD for date and HH:MM for time.")
         except Exception as e:
             await ctx.send(f"Error adding event: {str(e)}")
-            print(f"Add event error: {e}")
+            log.exception("Add event error")
 
-    async def send_event_reminder(guild_id, channel_id, event_id, event_name):
+    async def send_event_reminder(self, guild_id, channel_id, event_id, event_name):
         """Send a reminder for an upcoming event"""
         try:
-            channel = bot.get_channel(channel_id)
+            # Missed reminders run as soon as the scheduler starts, before the channel cache is filled
+            await self.bot.wait_until_ready()
+            channel = self.bot.get_channel(channel_id)
             if not channel:
+                log.warning("Event reminder for %s dropped: channel %s not found", event_id, channel_id)
                 return
             
             events = Data.Data.load_data("events")
@@ -115,10 +180,12 @@ class CalendarCog(commands.Cog):
                 
             event = events[event_id]
             event_datetime = datetime.datetime.fromisoformat(event["datetime"])
+            # Less than 15 minutes when a missed reminder is sent late
+            minutes_left = max(0, round((event_datetime - datetime.datetime.now()).total_seconds() / 60))
             
             embed = discord.Embed(
                 title="⏰ Event Reminder",
-                description=f"The event **{event_name}** is starting in 15 minutes!",
+                description=f"The event **{event_name}** is starting in {minutes_left} minutes!",
                 color=discord.Color.orange()
             )
             
@@ -127,10 +194,24 @@ class CalendarCog(commands.Cog):
             
             await channel.send(embed=embed)
             
-        except Exception as e:
-            print(f"Event reminder error: {e}")
+            # So a restart before the event starts does not send it again
+            event["reminded"] = True
+            Data.Data.update_record("events", event_id, event)
+            
+        except Exception:
+            log.exception("Event reminder error")
+
+    @staticmethod
+    def event_field(event):
+        """Embed field for one event in !events"""
+        # Format the date
+        formatted_time = datetime.datetime.fromisoformat(event["datetime"]).strftime("%a, %b %d at %I:%M %p")
+        
+        # Format the event title and include the event ID
+        title = f"{event['name']} (ID: {event['id']})"
+        return title, f"**When:** {formatted_time}\n**Description:** {event['description']}\n**Created by:** {event['creator_name']}"
 
-    @bot.command(name='events')
+    @commands.command(name='events')
     async def list_events(self, ctx):
         """List all upcoming events"""
         try:
@@ -140,48 +221,19 @@ class CalendarCog(commands.Cog):
                 await ctx.send("No events are currently scheduled!")
                 return
             
-            # Sort events by date/time
-            sorted_events = []
-            for event_id, event in events.items():
-                event_datetime = datetime.datetime.fromisoformat(event["datetime"])
-                if event_datetime > datetime.datetime.now():
-                    sorted_events.append((event_datetime, event))
-            
-            sorted_events.sort(key=lambda x: x[0])
-            
-            if not sorted_events:
-                await ctx.send("No upcoming events!")
-                return
-            
-            # Create an embed to display events
-            embed = discord.Embed(
-                title="📅 Upcoming Events",
-                color=discord.Color.blue()
-            )
-            
-            for event_time, event in sorted_events:
-                # Format the date
-                formatted_time = event_time.strftime("%a, %b %d at %I:%M %p")
-                
-                # Format the event title and include the event ID
-                title = f"{event['name']} (ID: {event['id']})"
-                
-                # Add field for this event
-                embed.add_field(
-                    name=title,
-                    value=f"**When:** {formatted_time}\n**Description:** {event['description']}\n**Created by:** {event['creator_name']}",
-                    inline=False
-                )
+            async def load():
+                # Upcoming events, already sorted by date/time
+                upcoming = await Data.Data.query("events", order_by="datetime", start=datetime.datetime.now().isoformat())
+                return upcoming, None
             
-            embed.set_footer(text="Use !delevent [ID] to remove an event")
-            
-            await ctx.send(embed=embed)
+            # Every member sees the same list, so its pages are shared
+            await self.pages.send(ctx, None, load, "No upcoming events!")
             
         except Exception as e:
             await ctx.send(f"Error listing events: {str(e)}")
-            print(f"List events error: {e}")
+            log.exception("List events error")
 
-    @bot.command(name='delevent')
+    @commands.command(name='delevent')
     async def delete_event(self, ctx, event_id=None):
         """Delete an event by its ID"""
         if not event_id:
@@ -206,12 +258,12 @@ class CalendarCog(commands.Cog):
                 return
             
             # Remove the event
-            del events[event_id]
-            Data.Data.save_data(events, "events")
+            Data.Data.delete_record("events", event_id)
+            self.pages.invalidate()
             
             # Cancel the reminder job if it exists
             try:
-                bot.scheduler.remove_job(f"reminder_{event_id}")
+                self.bot.scheduler.remove_job(f"reminder_{event_id}")
             except JobLookupError:
                 pass  # Job doesn't exist or already ran
             
@@ -219,7 +271,8 @@ class CalendarCog(commands.Cog):
             
         except Exception as e:
             await ctx.send(f"Error deleting event: {str(e)}")
-            print(f"Delete event error: {e}")
+            log.exception("Delete event error")
 
 async def setup(bot):
+    Data.Data.preload("events")
     await bot.add_cog(CalendarCog(bot))
@@ -0,0 +1,157 @@
+# Chart rendering for stats and subscription summaries
+import os
+import io
+import time
+import asyncio
+import datetime
+import importlib.util
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# matplotlib is optional, without it the commands only send their text output
+HAVE_MATPLOTLIB = importlib.util.find_spec('matplotlib') is not None
+
+# Worker processes, renders allowed in flight before new ones are refused,
+# and rendered images kept in memory
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', '2'))
+CHART_QUEUE_LIMIT = int(os.getenv('CHART_QUEUE_LIMIT', '4'))
+CHART_CACHE_SIZE = int(os.getenv('CHART_CACHE_SIZE', '64'))
+
+# Upper bounds (ms) of the render time histogram buckets
+TIMING_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+
+class ChartBusy(Exception):
+    """Raised when CHART_QUEUE_LIMIT renders are already waiting"""
+
+
+# The functions below run in the worker processes
+
+def _init_worker():
+    # Import matplotlib once per worker instead of on the first render
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot  # noqa: F401
+
+
+def _save(figure):
+    from matplotlib import pyplot
+    buffer = io.BytesIO()
+    figure.tight_layout()
+    figure.savefig(buffer, format='png', dpi=100)
+    pyplot.close(figure)
+    return buffer.getvalue()
+
+
+def line_chart(title, timestamps, series):
+    """PNG with one line plot per series (name -> values) sharing a time axis"""
+    from matplotlib import pyplot
+    times = [datetime.datetime.fromtimestamp(timestamp) for timestamp in timestamps]
+    figure, axes = pyplot.subplots(len(series), 1, figsize=(8, 1.8 * len(series)), sharex=True, squeeze=False)
+    for axis, (name, values) in zip(axes[:, 0], series.items()):
+        axis.plot(times, values, color='#57F287')
+        axis.set_ylabel(name)
+        axis.grid(alpha=0.3)
+    axes[0, 0].set_title(title)
+    figure.autofmt_xdate()
+    return _save(figure)
+
+
+def bar_chart(title, labels, values, xlabel):
+    """PNG with one horizontal bar per label"""
+    from matplotlib import pyplot
+    figure, axis = pyplot.subplots(figsize=(8, max(2, 0.4 * len(labels) + 1)))
+    axis.barh(labels, values, color='#5865F2')
+    axis.invert_yaxis()
+    axis.set_xlabel(xlabel)
+    axis.set_title(title)
+    axis.grid(axis='x', alpha=0.3)
+    return _save(figure)
+
+
+class ChartRenderer():
+    """Runs chart functions in a process pool so rendering never blocks the event loop.
+    Images are cached by a key that includes the version of the data they show"""
+
+    def __init__(self):
+        self.executor = None
+        self.cache = OrderedDict()
+        self.pending = {}
+        self.queued = 0
+
+        # Counters for !chartstats
+        self.rendered = 0
+        self.cache_hits = 0
+        self.rejected = 0
+        self.histogram = [0] * len(TIMING_BUCKETS)
+
+    async def render(self, key, func, *args):
+        """Return PNG bytes for func(*args); raises ChartBusy when the queue is full"""
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.cache_hits += 1
+            return self.cache[key]
+
+        # Same chart already being rendered: wait for that result
+        if key in self.pending:
+            return await asyncio.shield(self.pending[key])
+
+        if self.queued >= CHART_QUEUE_LIMIT:
+            self.rejected += 1
+            raise ChartBusy()
+
+        if self.executor is None:
+            # spawn: the bot process has running threads, which fork does not copy safely
+            self.executor = ProcessPoolExecutor(
+                max_workers=CHART_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker
+            )
+
+        started = time.perf_counter()
+        future = asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        self.pending[key] = future
+        self.queued += 1
+        future.add_done_callback(lambda _: self.finished(key, future, started))
+        return await asyncio.shield(future)
+
+    def finished(self, key, future, started):
+        # Bookkeeping runs when the render ends, even if every caller stopped waiting
+        self.queued -= 1
+        self.pending.pop(key, None)
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            # A worker died (e.g. killed for memory): start a fresh pool on the next render
+            if isinstance(future.exception(), BrokenProcessPool):
+                self.close()
+            return
+
+        elapsed = (time.perf_counter() - started) * 1000
+        self.histogram[next(i for i, bound in enumerate(TIMING_BUCKETS) if elapsed <= bound)] += 1
+        self.rendered += 1
+
+        self.cache[key] = future.result()
+        if len(self.cache) > CHART_CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def stats(self):
+        return {
+            "rendered": self.rendered,
+            "cache_hits": self.cache_hits,
+            "rejected": self.rejected,
+            "queued": self.queued,
+            "histogram": [(f"<={bound:g}ms" if bound != float('inf') else f">{TIMING_BUCKETS[-2]:g}ms", count)
+                          for bound, count in zip(TIMING_BUCKETS, self.histogram)],
+        }
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+# Shared by every cog that sends charts
+renderer = ChartRenderer()
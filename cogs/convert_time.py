@@ -1,57 +1,155 @@
 # Time converter implementation
+import logging
 import pytz
 import datetime
+from functools import lru_cache
 import discord
 from discord.ext import commands
-from dotenv import load_dotenv
+from .tz_resolver import TimezoneResolver
+from . import data
 
-load_dotenv()
+log = logging.getLogger(__name__)
 
-intents = discord.Intents.default()
-intents.members = True
-intents.message_content = True
+# Time formats accepted by the commands
+TIME_FORMATS = [
+    "%H:%M",        # 14:30
+    "%I:%M %p",     # 2:30 PM
+    "%I:%M%p",      # 2:30PM
+    "%I%p",         # 9am
+    "%I %p",        # 9 am
+    "%H%M",         # 1430
+]
+
+# Default timezones shown by !alltime, guilds can replace them with !guildzones
+MAJOR_TIMEZONES = [
+    "US/Pacific", "US/Mountain", "US/Central", "US/Eastern",
+    "Europe/Athens","Europe/London", "Europe/Paris", "Europe/Berlin", 
+    "Asia/Dubai", "Asia/Kolkata", "Asia/Singapore", 
+    "Asia/Tokyo", "Australia/Sydney", "Pacific/Auckland"
+]
+
+# An embed holds 25 fields and !alltime uses one for the original time
+MAX_GUILD_ZONES = 24
+
+# Data collections: user id -> {"timezone"} and guild id -> {"zones"}
+USER_TIMEZONES = "user_timezones"
+GUILD_TIMEZONES = "guild_timezones"
+
+
+@lru_cache(maxsize=None)
+def get_timezone(name):
+    """pytz.timezone() with the zone objects kept after the first lookup"""
+    return pytz.timezone(name)
+
+
+@lru_cache(maxsize=1024)
+def parse_time(time_str):
+    """Parse a time string in any of TIME_FORMATS, or return None"""
+    for fmt in TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(time_str, fmt).time()
+        except ValueError:
+            continue
+    return None
+
+
+@lru_cache(maxsize=None)
+def display_name(tz_name):
+    """Short label for a zone, e.g. "New York" for America/New_York"""
+    return tz_name.replace("_", " ").split("/")[-1]
+
+
+# Converted !alltime fields keyed by (source zone, date, time, zones shown). The date is
+# part of the key, so entries computed before a DST transition are never reused after it
+@lru_cache(maxsize=2048)
+def all_timezone_fields(from_tz, date, parsed_time, zones):
+    source_tz = get_timezone(from_tz)
+    source_datetime = source_tz.localize(datetime.datetime.combine(date, parsed_time))
+
+    fields = []
+    for tz_name in zones:
+        converted_time = source_datetime.astimezone(get_timezone(tz_name))
+        fields.append((display_name(tz_name), f"{converted_time.strftime('%I:%M %p')} ({tz_name})"))
+    return source_datetime.strftime('%I:%M %p'), fields
+
+
+def split_time(time_str, zones):
+    """Join a separate AM/PM word back onto the time: ("2:30", "PM", "EST") -> "2:30 PM", ["EST"]"""
+    if time_str and zones and zones[0].lower() in ("am", "pm"):
+        return f"{time_str} {zones[0]}", list(zones[1:])
+    return time_str, list(zones)
 
-bot = commands.Bot(command_prefix='!',intents=intents) 
 
 class TimeConverter(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        
+        # Index of zone names, abbreviations and cities, built once at load
+        self.resolver = TimezoneResolver()
+        
+        # Build the zone objects and labels !alltime shows by default now, not on its first use
+        for tz_name in MAJOR_TIMEZONES:
+            get_timezone(tz_name)
+            display_name(tz_name)
+        
+    @staticmethod
+    def user_timezone(user_id):
+        """Saved timezone of a user, or None (served from the in-memory Data store)"""
+        record = data.Data.load_data(USER_TIMEZONES).get(str(user_id))
+        return record["timezone"] if record else None
 
-    @bot.command(name='convert')
-    async def convert_time(self, ctx, time_str=None, from_tz=None, to_tz=None):
+    @staticmethod
+    def guild_zones(guild_id):
+        """Zones shown by !alltime in a guild; the defaults unless the guild configured its own"""
+        record = data.Data.load_data(GUILD_TIMEZONES).get(str(guild_id))
+        return tuple(record["zones"]) if record else tuple(MAJOR_TIMEZONES)
+
+    async def resolve_timezone(self, ctx, text):
+        """Resolve a user supplied timezone, replying with suggestions when it is unknown"""
+        zone = self.resolver.resolve(text)
+        if zone is None:
+            suggestions = self.resolver.suggest(text)
+            message = f"Unknown timezone '{text}'."
+            if suggestions:
+                message += f" Did you mean: {', '.join(suggestions)}?"
+            else:
+                message += " Use names like 'US/Eastern', 'Europe/London', 'EST' or 'Tokyo'."
+            await ctx.send(message)
+        return zone
+
+    @commands.command(name='convert')
+    async def convert_time(self, ctx, time_str=None, *zones):
         """Convert time from one timezone to another"""
-        if not all([time_str, from_tz, to_tz]):
+        time_str, zones = split_time(time_str, zones)
+        
+        # With one timezone the user's saved timezone is the source
+        if time_str and len(zones) == 1:
+            zones.insert(0, self.user_timezone(ctx.author.id))
+            if zones[0] is None:
+                await ctx.send("Set your timezone with `!settz [timezone]` or use `!convert [time] [from_timezone] [to_timezone]`")
+                return
+        
+        if not time_str or len(zones) != 2:
             await ctx.send("Please provide all required parameters: `!convert [time] [from_timezone] [to_timezone]`")
             return
+        from_tz, to_tz = zones
         
         try:
-            # Check if timezones are valid
-            try:
-                source_tz = pytz.timezone(from_tz)
-                target_tz = pytz.timezone(to_tz)
-            except pytz.exceptions.UnknownTimeZoneError:
-                await ctx.send(f"Invalid timezone. Use common timezone names like 'US/Eastern', 'Europe/London', etc.")
+            # Resolve the timezones (abbreviations, cities and typos are accepted)
+            from_tz = await self.resolve_timezone(ctx, from_tz)
+            if from_tz is None:
+                return
+            to_tz = await self.resolve_timezone(ctx, to_tz)
+            if to_tz is None:
                 return
+            source_tz = get_timezone(from_tz)
+            target_tz = get_timezone(to_tz)
             
             # Parse the time string (supporting common formats)
-            parsed_time = None
-            time_formats = [
-                "%H:%M",        # 14:30
-                "%I:%M %p",     # 2:30 PM
-                "%I:%M%p",      # 2:30PM
-                "%H%M",         # 1430
-            ]
-            
-            for fmt in time_formats:
-                try:
-                    parsed_time_obj = datetime.datetime.strptime(time_str, fmt)
-                    parsed_time = parsed_time_obj.time()
-                    break
-                except ValueError:
-                    continue
+            parsed_time = parse_time(time_str)
             
             if not parsed_time:
-                await ctx.send("Invalid time format. Please use formats like '14:30' or '2:30 PM'.")
+                await ctx.send("Invalid time format. Please use formats like '14:30', '2:30 PM' or '9am'.")
                 return
             
             # Get current date in source timezone
@@ -84,56 +182,39 @@ class TimeConverter(commands.Cog):
             
         except Exception as e:
             await ctx.send(f"Error converting time: {str(e)}")
-            print(f"Time conversion error: {e}")
+            log.exception("Time conversion error")
 
-    @bot.command(name='alltime')
-    async def show_all_timezones(self, ctx, time_str=None, from_tz=None):
+    @commands.command(name='alltime')
+    async def show_all_timezones(self, ctx, time_str=None, *zones):
         """Show the provided time in all major timezones"""
-        if not all([time_str, from_tz]):
+        time_str, zones = split_time(time_str, zones)
+        from_tz = zones[0] if zones else self.user_timezone(ctx.author.id)
+        
+        if not time_str or len(zones) > 1:
             await ctx.send("Please provide all required parameters: `!alltime [time] [from_timezone]`")
             return
+        if from_tz is None:
+            await ctx.send("Set your timezone with `!settz [timezone]` or use `!alltime [time] [from_timezone]`")
+            return
         
         try:
-            # Check if source timezone is valid
-            try:
-                source_tz = pytz.timezone(from_tz)
-            except pytz.exceptions.UnknownTimeZoneError:
-                await ctx.send(f"Invalid timezone. Use common timezone names like 'US/Eastern', 'Europe/London', etc.")
+            # Resolve the source timezone (abbreviations, cities and typos are accepted)
+            from_tz = await self.resolve_timezone(ctx, from_tz)
+            if from_tz is None:
                 return
+            source_tz = get_timezone(from_tz)
             
             # Parse the time string (supporting common formats)
-            parsed_time = None
-            time_formats = [
-                "%H:%M",        # 14:30
-                "%I:%M %p",     # 2:30 PM
-                "%I:%M%p",      # 2:30PM
-                "%H%M",         # 1430
-            ]
-            
-            for fmt in time_formats:
-                try:
-                    parsed_time_obj = datetime.datetime.strptime(time_str, fmt)
-                    parsed_time = parsed_time_obj.time()
-                    break
-                except ValueError:
-                    continue
+            parsed_time = parse_time(time_str)
             
             if not parsed_time:
-                await ctx.send("Invalid time format. Please use formats like '14:30' or '2:30 PM'.")
+                await ctx.send("Invalid time format. Please use formats like '14:30', '2:30 PM' or '9am'.")
                 return
             
             # Get current date in source timezone
-            now = datetime.datetime.now(source_tz)
-            source_datetime = datetime.datetime.combine(now.date(), parsed_time)
-            source_datetime = source_tz.localize(source_datetime)
-            
-            # List of major timezones to display
-            major_timezones = [
-                "US/Pacific", "US/Mountain", "US/Central", "US/Eastern",
-                "Europe/Athens","Europe/London", "Europe/Paris", "Europe/Berlin", 
-                "Asia/Dubai", "Asia/Kolkata", "Asia/Singapore", 
-                "Asia/Tokyo", "Australia/Sydney", "Pacific/Auckland"
-            ]
+            today = datetime.datetime.now(source_tz).date()
+            shown_zones = self.guild_zones(ctx.guild.id) if ctx.guild else tuple(MAJOR_TIMEZONES)
+            source_time, fields = all_timezone_fields(from_tz, today, parsed_time, shown_zones)
             
             # Create the embed
             embed = discord.Embed(
@@ -145,32 +226,97 @@ class TimeConverter(commands.Cog):
             # Add source time for reference
             embed.add_field(
                 name="Original Time",
-                value=f"{source_datetime.strftime('%I:%M %p')} {from_tz}",
+                value=f"{source_time} {from_tz}",
                 inline=False
             )
             
-            # Convert to each major timezone
-            for tz_name in major_timezones:
-                try:
-                    tz = pytz.timezone(tz_name)
-                    converted_time = source_datetime.astimezone(tz)
-                    
-                    # Get a user-friendly timezone name
-                    friendly_name = tz_name.replace("_", " ").split("/")[-1]
-                    
-                    embed.add_field(
-                        name=friendly_name,
-                        value=f"{converted_time.strftime('%I:%M %p')} ({tz_name})",
-                        inline=True
-                    )
-                except pytz.exceptions.UnknownTimeZoneError:
-                    continue
+            # Converted time in each major timezone
+            for friendly_name, value in fields:
+                embed.add_field(name=friendly_name, value=value, inline=True)
             
             await ctx.send(embed=embed)
             
         except Exception as e:
             await ctx.send(f"Error showing time in all timezones: {str(e)}")
-            print(f"All timezones error: {e}")
+            log.exception("All timezones error")
+
+    @commands.command(name='settz')
+    async def set_timezone(self, ctx, *, timezone=None):
+        """Save your default timezone for !convert and !alltime"""
+        if timezone is None:
+            current = self.user_timezone(ctx.author.id)
+            if current:
+                await ctx.send(f"Your timezone is {current}. Change it with `!settz [timezone]` or remove it with `!settz clear`.")
+            else:
+                await ctx.send("You have not set a timezone. Use `!settz [timezone]`, e.g. `!settz Europe/Athens`")
+            return
+        
+        if timezone.lower() == "clear":
+            data.Data.delete_record(USER_TIMEZONES, str(ctx.author.id))
+            await ctx.send("Your timezone has been removed.")
+            return
+        
+        zone = await self.resolve_timezone(ctx, timezone)
+        if zone is None:
+            return
+        data.Data.update_record(USER_TIMEZONES, str(ctx.author.id), {"timezone": zone})
+        await ctx.send(f"Your timezone is now {zone}.")
+
+    @commands.group(name='guildzones', invoke_without_command=True)
+    @commands.guild_only()
+    async def guild_zones_command(self, ctx):
+        """Show the timezones !alltime uses in this server"""
+        zones = self.guild_zones(ctx.guild.id)
+        embed = discord.Embed(
+            title=f"!alltime timezones for {ctx.guild.name}",
+            description="\n".join(zones),
+            color=discord.Color.gold()
+        )
+        embed.set_footer(text="Admins: !guildzones add/remove [timezones...] or !guildzones reset")
+        await ctx.send(embed=embed)
+
+    @guild_zones_command.command(name='add')
+    @commands.has_role('admin')
+    async def guild_zones_add(self, ctx, *timezones):
+        """Add timezones to this server's !alltime list"""
+        zones = list(self.guild_zones(ctx.guild.id))
+        for timezone in timezones:
+            zone = await self.resolve_timezone(ctx, timezone)
+            if zone is None:
+                return
+            if zone not in zones:
+                zones.append(zone)
+        
+        if len(zones) > MAX_GUILD_ZONES:
+            await ctx.send(f"A server can show at most {MAX_GUILD_ZONES} timezones.")
+            return
+        data.Data.update_record(GUILD_TIMEZONES, str(ctx.guild.id), {"zones": zones})
+        await ctx.send(f"!alltime now shows {len(zones)} timezones.")
+
+    @guild_zones_command.command(name='remove')
+    @commands.has_role('admin')
+    async def guild_zones_remove(self, ctx, *timezones):
+        """Remove timezones from this server's !alltime list"""
+        zones = list(self.guild_zones(ctx.guild.id))
+        for timezone in timezones:
+            zone = await self.resolve_timezone(ctx, timezone)
+            if zone is None:
+                return
+            if zone in zones:
+                zones.remove(zone)
+        
+        if not zones:
+            await ctx.send("At least one timezone has to stay. Use `!guildzones reset` for the defaults.")
+            return
+        data.Data.update_record(GUILD_TIMEZONES, str(ctx.guild.id), {"zones": zones})
+        await ctx.send(f"!alltime now shows {len(zones)} timezones.")
+
+    @guild_zones_command.command(name='reset')
+    @commands.has_role('admin')
+    async def guild_zones_reset(self, ctx):
+        """Go back to the default !alltime timezones"""
+        data.Data.delete_record(GUILD_TIMEZONES, str(ctx.guild.id))
+        await ctx.send("!alltime now shows the default timezones.")
 
 async def setup(bot):
     await bot.add_cog(TimeConverter(bot))
\ No newline at end of file
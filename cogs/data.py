@@ -1,19 +1,171 @@
+import logging
 import os
 import json
+import time
+import asyncio
+import sqlite3
 import datetime
+from collections import defaultdict
+from .sqlite_store import SqliteStore
+
+log = logging.getLogger(__name__)
+
+# Seconds to wait after a mutation so bursts of writes to a collection become one flush
+SAVE_DELAY = float(os.getenv('DATA_SAVE_DELAY', '1.0'))
+
+# Storage backend per collection: "json", "journal" or "sqlite",
+# e.g. DATA_BACKENDS=subscriptions:journal,events:sqlite
+# Collections that are not listed use the plain "json" backend
+BACKENDS = dict(item.strip().split(':', 1) for item in os.getenv('DATA_BACKENDS', '').split(',') if item.strip())
+
+# Journal size (bytes) after which it is folded back into the snapshot file
+JOURNAL_COMPACT_BYTES = int(os.getenv('DATA_JOURNAL_COMPACT_BYTES', str(1024 * 1024)))
 
 
 class Data():
+    # Process-wide store: collection name -> records, shared by every cog
+    # Each collection is read from disk once and then served from memory
+    _store = {}
+
+    # Background persistence state: collection -> pending journal lines, or None when
+    # the whole collection has to be rewritten; plus the worker task
+    _dirty = {}
+    _flush_task = None
+    _flush_now = None
+    _write_lock = None
+
+    # Shared SQLite engine, created the first time a collection uses the "sqlite" backend
+    _sqlite = None
+
+    # Storage I/O counters for !botmetrics: operation -> [count, seconds]
+    io_stats = defaultdict(lambda: [0, 0.0])
+
     def __init__(self, bot):
         self.bot = bot
 
+    @staticmethod
+    def _record_io(operation, started):
+        entry = Data.io_stats[operation]
+        entry[0] += 1
+        entry[1] += time.perf_counter() - started
+
+    @staticmethod
+    def backend(filename):
+        """Name of the storage backend used for a collection ("json", "journal" or "sqlite")"""
+        return BACKENDS.get(filename, 'json')
+
+    @staticmethod
+    def sqlite_store():
+        if Data._sqlite is None:
+            Data._sqlite = SqliteStore()
+        return Data._sqlite
+
+    @staticmethod
+    def _read_sqlite(filename):
+        store = Data.sqlite_store()
+        # First start on SQLite: import the existing JSON data once
+        if store.count(filename) == 0 and (os.path.exists(f'data/{filename}.json') or os.path.exists(f'data/{filename}.journal')):
+            store.replace(filename, Data._read_file(filename))
+            Data.retire_files(filename)
+        return store.load(filename)
+
+    @staticmethod
+    def retire_files(filename):
+        """Rename an imported collection's JSON snapshot and journal to *.imported, so an
+        emptied SQLite collection is not filled from them again on the next start"""
+        for path in (f'data/{filename}.json', f'data/{filename}.journal'):
+            if os.path.exists(path):
+                os.replace(path, f'{path}.imported')
+
     # Data storage using JSON files)
-    def load_data(filename):
+    @staticmethod
+    def _read_file(filename):
+        path = f'data/{filename}.json'
         try:
-            with open(f'data/{filename}.json', 'r') as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            return {}
+            with open(path, 'r') as f:
+                records = json.load(f)
+        except FileNotFoundError:
+            records = {}
+        except json.JSONDecodeError as e:
+            # Keep the damaged file aside instead of overwriting it on the next save
+            log.error("Data load error: %s is corrupt (%s), moved to %s.corrupt", path, e, path)
+            os.replace(path, f'{path}.corrupt')
+            records = {}
+
+        # Replay the journal on top of the snapshot. This runs for every backend so a
+        # collection can be switched between "journal" and "json" without losing writes
+        Data._replay_journal(records, filename)
+        return records
+
+    @staticmethod
+    def _replay_journal(records, filename):
+        try:
+            with open(f'data/{filename}.journal', 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A crash mid-append can only damage the last line
+                        log.warning("Data load warning: skipped a damaged line in data/%s.journal", filename)
+                        continue
+
+                    if entry["op"] == "set":
+                        records[entry["id"]] = entry["record"]
+                    elif entry["op"] == "delete":
+                        records.pop(entry["id"], None)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def preload(*filenames):
+        """Load collections into memory ahead of the first command that needs them"""
+        for filename in filenames:
+            Data.load_data(filename)
+
+    @staticmethod
+    async def preload_sqlite():
+        """Load every collection on the "sqlite" backend in a worker thread at startup. Their
+        first read (and a JSON import) waits on the SQLite thread, which a command must never do"""
+        filenames = [filename for filename, backend in BACKENDS.items() if backend == 'sqlite']
+        if filenames:
+            await asyncio.to_thread(Data.preload, *filenames)
+
+    @staticmethod
+    def load_data(filename):
+        """Return the resident records for a collection, reading the file only on first use.
+        The returned dict is the live copy, so mutations must be followed by save_data"""
+        if filename not in Data._store:
+            started = time.perf_counter()
+            if Data.backend(filename) == 'sqlite':
+                Data._store[filename] = Data._read_sqlite(filename)
+            else:
+                Data._store[filename] = Data._read_file(filename)
+            Data._record_io("load", started)
+        return Data._store[filename]
+
+    @staticmethod
+    async def query(filename, order_by=None, start=None, **filters):
+        """Return the records whose fields equal the given filters, optionally sorted by
+        order_by and limited to values >= start. SQLite collections use their indexes,
+        the others are filtered in memory"""
+        records = Data.load_data(filename)
+
+        if Data.backend(filename) != 'sqlite':
+            matches = [record for record in records.values()
+                       if all(record.get(field) == value for field, value in filters.items())]
+            if order_by is not None:
+                if start is not None:
+                    matches = [record for record in matches if record.get(order_by) is not None and record[order_by] >= start]
+                matches.sort(key=lambda record: record.get(order_by) or '')
+            return matches
+
+        # Make sure the database has seen every pending write before asking it
+        if filename in Data._dirty:
+            await Data._flush_dirty()
+        started = time.perf_counter()
+        ids = await Data.sqlite_store().select_ids(asyncio.get_running_loop(), filename, order_by, start, filters)
+        Data._record_io("sqlite_query", started)
+        return [records[record_id] for record_id in ids if record_id in records]
 
     # Helper class to encode datetime automatically
     class DateTimeEncoder(json.JSONEncoder):
@@ -32,13 +184,153 @@ class Data():
         elif isinstance(obj, datetime.datetime):
             return obj.isoformat()
         else:
-            return obj    
+            return obj
 
-    @staticmethod                   #doesnt use self 
-    def save_data(data, filename):
+    @staticmethod
+    def _encode(filename):
+        return json.dumps(Data._store[filename], indent=4, cls=Data.DateTimeEncoder)
+
+    @staticmethod
+    def _write_file(payload, filename):
+        """Atomically replace data/<filename>.json: write a temp file, fsync it, then rename.
+        The journal is emptied afterwards since the snapshot now contains every entry"""
         os.makedirs('data', exist_ok=True)
-        with open(f'data/{filename}.json', 'w') as f:
-            json.dump(data, f, indent=4, cls=Data.DateTimeEncoder)
+        path = f'data/{filename}.json'
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        # Journal entries are idempotent, so a crash before this truncate is harmless
+        if os.path.exists(f'data/{filename}.journal'):
+            open(f'data/{filename}.journal', 'w').close()
+
+    @staticmethod
+    def _append_journal(lines, filename):
+        """Append entries to data/<filename>.journal and return the journal size"""
+        os.makedirs('data', exist_ok=True)
+        with open(f'data/{filename}.journal', 'a') as f:
+            f.write(''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+            return f.tell()
+
+    @staticmethod                   #doesnt use self
+    def save_data(data, filename):
+        """Replace the resident records for a collection and queue them for persistence.
+        Writes inside the SAVE_DELAY window are coalesced into one background flush"""
+        Data._store[filename] = data
+        Data._dirty[filename] = None
+        Data._schedule_flush()
+
+    @staticmethod
+    def update_record(filename, record_id, record):
+        """Add or replace one record; the journal and sqlite backends persist just this record"""
+        Data.load_data(filename)[record_id] = record
+        Data._queue_entry(filename, {"op": "set", "id": record_id, "record": record})
+
+    @staticmethod
+    def update_records(filename, records):
+        """Add or replace many records (record_id -> record) with a single flush"""
+        store = Data.load_data(filename)
+        for record_id, record in records.items():
+            store[record_id] = record
+            Data._queue_entry(filename, {"op": "set", "id": record_id, "record": record})
+
+    @staticmethod
+    def delete_record(filename, record_id):
+        """Remove one record if it exists"""
+        Data.load_data(filename).pop(record_id, None)
+        Data._queue_entry(filename, {"op": "delete", "id": record_id})
+
+    @staticmethod
+    def _queue_entry(filename, entry):
+        if Data.backend(filename) == 'json':
+            Data._dirty[filename] = None
+        elif Data._dirty.get(filename, []) is not None:
+            # Encode now: the record dict may be mutated again before the flush runs
+            line = json.dumps(entry, cls=Data.DateTimeEncoder) + '\n'
+            Data._dirty.setdefault(filename, []).append(line)
+        Data._schedule_flush()
+
+    @staticmethod
+    def _schedule_flush():
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (e.g. a script), write straight away
+            for name, lines in Data._dirty.items():
+                if Data.backend(name) == 'sqlite':
+                    Data.sqlite_store().replace(name, Data._store[name])
+                elif lines is None:
+                    Data._write_file(Data._encode(name), name)
+                else:
+                    Data._append_journal(lines, name)
+            Data._dirty.clear()
+            return
+
+        if Data._flush_task is None or Data._flush_task.done():
+            Data._flush_now = asyncio.Event()
+            Data._flush_task = loop.create_task(Data._flush_later())
+
+    @staticmethod
+    async def _flush_later():
+        """Wait for the debounce window (or an early flush request) and write dirty collections"""
+        try:
+            await asyncio.wait_for(Data._flush_now.wait(), timeout=SAVE_DELAY)
+        except asyncio.TimeoutError:
+            pass
+        await Data._flush_dirty()
+
+    @staticmethod
+    async def _flush_dirty():
+        if Data._write_lock is None:
+            Data._write_lock = asyncio.Lock()
+
+        loop = asyncio.get_running_loop()
+        failed = {}
+        async with Data._write_lock:
+            while Data._dirty:
+                pending = Data._dirty
+                Data._dirty = {}
+                for filename, lines in pending.items():
+                    started = time.perf_counter()
+                    try:
+                        if Data.backend(filename) == 'sqlite':
+                            if lines is None:
+                                await Data.sqlite_store().replace_async(loop, filename, Data._store[filename])
+                            else:
+                                await Data.sqlite_store().apply(loop, filename, [json.loads(line) for line in lines])
+                            Data._record_io("sqlite_write", started)
+                            continue
+
+                        if lines is not None:
+                            size = await loop.run_in_executor(None, Data._append_journal, lines, filename)
+                            Data._record_io("journal_append", started)
+                            if size < JOURNAL_COMPACT_BYTES:
+                                continue
+                            started = time.perf_counter()
+                        # Full rewrite, or compaction of a journal that grew past the threshold.
+                        # Encode on the loop so the executor never sees a dict that is being mutated
+                        payload = Data._encode(filename)
+                        await loop.run_in_executor(None, Data._write_file, payload, filename)
+                        Data._record_io("snapshot_write", started)
+                    except (OSError, sqlite3.Error) as e:
+                        Data._record_io("write_error", started)
+                        log.error("Data save error (%s): %s", filename, e)
+                        failed[filename] = None
+            # Failed collections stay dirty and are rewritten in full on the next save
+            Data._dirty.update(failed)
+
+    @staticmethod
+    async def flush():
+        """Write every pending collection now; called on shutdown so no mutation is lost"""
+        if Data._flush_task is not None and not Data._flush_task.done():
+            Data._flush_now.set()
+            await Data._flush_task
+        await Data._flush_dirty()
 
 async def setup(bot):
     await bot.add_cog(Data(bot))
@@ -0,0 +1,456 @@
+# Dice expression engine used by the dice roller cog
+#
+# Supported notation (case and spaces are ignored):
+#   2d6+1d8+3    several dice and constant terms added or subtracted
+#   d20, d%      a missing count means 1, % means 100 sides
+#   4d6kh3       keep the highest 3 (k3 is the same), kl keeps the lowest
+#   4d6dl1       drop the lowest 1, dh drops the highest
+#   3d6!         exploding dice: a max roll adds another die
+#   2d20r1       reroll results of 1 or lower once
+#   6x4d6kh3     roll the whole expression 6 times
+#
+# With NumPy installed, large terms are drawn in one batched call and the exact outcome
+# distribution of an expression (stats mode) is computed with fast convolutions
+import re
+import math
+import random
+from collections import Counter, namedtuple
+from functools import lru_cache
+from itertools import combinations_with_replacement
+
+try:
+    import numpy as np
+    rng = np.random.default_rng()
+except ImportError:
+    np = None
+
+# Limits to keep a single roll cheap
+MAX_DICE = 1_000_000            # dice per expression
+MAX_SIDES = 10_000
+MAX_REPEAT = 20
+MAX_TERMS = 20
+EXPLODE_LIMIT = 100             # extra dice one exploding die may add
+
+# Individual results are only kept (and displayed) for terms with at most this many dice
+DISPLAY_LIMIT = 20
+
+# Dice are drawn in chunks so huge rolls never hold more than this many results at once.
+# NumPy arrays are compact enough to draw a whole term in one call
+CHUNK_SIZE = 10_000
+NUMPY_CHUNK_SIZE = MAX_DICE
+
+# Stats mode limits: widest total range, keep/drop combinations to enumerate, and
+# multiply-adds allowed for the pure Python convolution when NumPy is missing
+STATS_MAX_RANGE = 1_000_000
+STATS_MAX_COMBINATIONS = 200_000
+STATS_MAX_PYTHON_WORK = 20_000_000
+
+# Exploding dice have no upper bound; the distribution is cut where probabilities drop below this
+STATS_TAIL = 1e-15
+
+DICE_PATTERN = re.compile(r"(\d*)d(\d+|%)")
+MODIFIER_PATTERN = re.compile(r"(kh|kl|dh|dl|k|r|!)(\d*)")
+TERM_PATTERN = re.compile(r"([+-]?)(?:(\d*d(?:\d+|%)(?:(?:kh|kl|dh|dl|k|r|!)\d*)*)|(\d+))")
+REPEAT_PATTERN = re.compile(r"^(\d+)x(?=.)")
+
+# Parsed form of an expression
+Dice = namedtuple('Dice', 'sign count sides keep explode reroll')     # keep: None or ('h'|'l', n)
+Constant = namedtuple('Constant', 'sign value')
+Expression = namedtuple('Expression', 'terms repeat')
+
+# Result of rolling one dice term: rolls/kept are None when the results were not kept
+TermResult = namedtuple('TermResult', 'term total rolls kept')
+
+
+class DiceError(ValueError):
+    """The expression is not valid dice notation or goes over a limit"""
+
+
+def normalize(notation):
+    return "".join(notation.lower().split())
+
+
+@lru_cache(maxsize=1024)
+def _parse(text):
+    repeat = 1
+    match = REPEAT_PATTERN.match(text)
+    if match:
+        repeat = int(match.group(1))
+        text = text[match.end():]
+        if not 1 <= repeat <= MAX_REPEAT:
+            raise DiceError(f"You can repeat a roll at most {MAX_REPEAT} times.")
+
+    terms = []
+    position = 0
+    total_dice = 0
+    while position < len(text):
+        match = TERM_PATTERN.match(text, position)
+        if not match or match.end() == position or (terms and not match.group(1)):
+            raise DiceError("Invalid dice notation! Please use a format like '2d6+3' or '4d6kh3'.")
+        position = match.end()
+        sign = -1 if match.group(1) == '-' else 1
+
+        if match.group(3) is not None:
+            terms.append(Constant(sign, int(match.group(3))))
+            continue
+
+        term = _parse_dice(match.group(2), sign)
+        total_dice += term.count
+        terms.append(term)
+
+    if not terms:
+        raise DiceError("Invalid dice notation! Please use a format like '2d6+3' or '4d6kh3'.")
+    if len(terms) > MAX_TERMS:
+        raise DiceError(f"Too many terms! Please use {MAX_TERMS} or fewer.")
+    if total_dice * repeat > MAX_DICE:
+        raise DiceError(f"Too many dice! Please roll {MAX_DICE:,} or fewer.")
+
+    return Expression(tuple(terms), repeat)
+
+
+def _parse_dice(text, sign):
+    match = DICE_PATTERN.match(text)
+    count = int(match.group(1)) if match.group(1) else 1
+    sides = 100 if match.group(2) == '%' else int(match.group(2))
+
+    if count < 1 or sides < 1:
+        raise DiceError("Dice need at least one die and one side.")
+    if sides > MAX_SIDES:
+        raise DiceError(f"Dice too large! Please use dice with {MAX_SIDES:,} or fewer sides.")
+
+    keep = None
+    explode = False
+    reroll = 0
+    for name, value in MODIFIER_PATTERN.findall(text[match.end():]):
+        if name == '!':
+            if value:
+                raise DiceError("Exploding dice are written as '3d6!'.")
+            explode = sides > 1
+        elif name == 'r':
+            reroll = int(value) if value else 1
+            if reroll >= sides:
+                raise DiceError("A reroll must leave at least one result that is not rerolled.")
+        else:
+            if not value:
+                raise DiceError(f"'{name}' needs a number, e.g. '4d6{name}1'.")
+            amount = int(value)
+            # Dropping n dice is the same as keeping the other count - n
+            if name in ('kh', 'k'):
+                keep = ('h', amount)
+            elif name == 'kl':
+                keep = ('l', amount)
+            elif name == 'dl':
+                keep = ('h', count - amount)
+            else:
+                keep = ('l', count - amount)
+            if not 0 <= keep[1] <= count:
+                raise DiceError("You can't keep or drop more dice than you roll.")
+
+    return Dice(sign, count, sides, keep, explode, reroll)
+
+
+def parse(notation):
+    """Parse dice notation into an Expression; parsed expressions are cached"""
+    return _parse(normalize(notation))
+
+
+def _roll_die(term):
+    value = random.randint(1, term.sides)
+    if term.reroll and value <= term.reroll:
+        value = random.randint(1, term.sides)
+    if term.explode:
+        total = value
+        extra = 0
+        while value == term.sides and extra < EXPLODE_LIMIT:
+            value = random.randint(1, term.sides)
+            total += value
+            extra += 1
+        value = total
+    return value
+
+
+def _draw(term, amount):
+    """Results for `amount` dice of a term"""
+    if term.explode or term.reroll:
+        return [_roll_die(term) for _ in range(amount)]
+    return random.choices(range(1, term.sides + 1), k=amount)
+
+
+def _roll_listed(term):
+    rolls = _draw(term, term.count)
+    kept = [True] * len(rolls)
+    if term.keep is not None:
+        order = sorted(range(len(rolls)), key=lambda i: rolls[i], reverse=term.keep[0] == 'h')
+        for i in order[term.keep[1]:]:
+            kept[i] = False
+    total = sum(roll for roll, keep in zip(rolls, kept) if keep)
+    return TermResult(term, total, rolls, kept)
+
+
+def _draw_numpy(term, amount):
+    """Results for `amount` dice of a term as a NumPy array, drawn in batches"""
+    values = rng.integers(1, term.sides + 1, size=amount)
+    if term.reroll:
+        low = values <= term.reroll
+        values[low] = rng.integers(1, term.sides + 1, size=int(low.sum()))
+    if term.explode:
+        exploding = np.flatnonzero(values == term.sides)
+        extra = 0
+        while exploding.size and extra < EXPLODE_LIMIT:
+            more = rng.integers(1, term.sides + 1, size=exploding.size)
+            values[exploding] += more
+            exploding = exploding[more == term.sides]
+            extra += 1
+    return values
+
+
+def _roll_streamed(term):
+    """Roll without keeping every result: plain sums are added chunk by chunk and
+    keep/drop uses a tally of how often each value came up"""
+    remaining = term.count
+    total = 0
+    tally = Counter() if term.keep is not None else None
+    while remaining:
+        if np is not None:
+            amount = min(remaining, NUMPY_CHUNK_SIZE)
+            chunk = _draw_numpy(term, amount)
+        else:
+            amount = min(remaining, CHUNK_SIZE)
+            chunk = _draw(term, amount)
+        remaining -= amount
+        if tally is None:
+            total += int(sum(chunk) if np is None else chunk.sum())
+        elif np is not None:
+            counts = np.bincount(chunk)
+            tally.update({value: int(counts[value]) for value in np.flatnonzero(counts)})
+        else:
+            tally.update(chunk)
+
+    if tally is not None:
+        direction, wanted = term.keep
+        for value in sorted(tally, reverse=direction == 'h'):
+            taken = min(wanted, tally[value])
+            total += taken * value
+            wanted -= taken
+            if not wanted:
+                break
+
+    return TermResult(term, total, None, None)
+
+
+def roll_expression(expression):
+    """Roll an expression once; returns (total, [TermResult or Constant, ...])"""
+    parts = []
+    total = 0
+    for term in expression.terms:
+        if isinstance(term, Constant):
+            total += term.sign * term.value
+            parts.append(term)
+            continue
+        result = _roll_listed(term) if term.count <= DISPLAY_LIMIT else _roll_streamed(term)
+        total += term.sign * result.total
+        parts.append(result)
+    return total, parts
+
+
+def roll(notation):
+    """Parse and roll an expression, honouring its repeat count.
+    Returns (expression, [(total, parts), ...])"""
+    expression = parse(notation)
+    return expression, [roll_expression(expression) for _ in range(expression.repeat)]
+
+
+def describe(parts):
+    """Text breakdown of one roll, e.g. '[6, 5, ~~2~~, 4] + 3'"""
+    pieces = []
+    for part in parts:
+        term = part if isinstance(part, Constant) else part.term
+        sign = "-" if term.sign < 0 else "+"
+        if isinstance(part, Constant):
+            text = str(part.value)
+        elif part.rolls is None:
+            text = f"({part.total})"
+        else:
+            text = "[" + ", ".join(str(roll) if keep else f"~~{roll}~~" for roll, keep in zip(part.rolls, part.kept)) + "]"
+        pieces.append(text if not pieces and sign == "+" else f"{sign} {text}")
+    return " ".join(pieces)
+
+
+# Stats mode: exact outcome distributions
+
+def _convolve(a, b):
+    if np is not None:
+        if len(a) * len(b) > 1_000_000:
+            # FFT convolution; tiny negative rounding errors are clipped
+            size = len(a) + len(b) - 1
+            result = np.fft.irfft(np.fft.rfft(a, size) * np.fft.rfft(b, size), size)
+            return np.clip(result, 0, None)
+        return np.convolve(a, b)
+
+    result = [0.0] * (len(a) + len(b) - 1)
+    for i, x in enumerate(a):
+        if x:
+            for j, y in enumerate(b):
+                result[i + j] += x * y
+    return result
+
+
+def _die_distribution(term):
+    """Probabilities of one die's result as {value: probability}"""
+    face = 1 / term.sides
+    first = {value: face for value in range(1, term.sides + 1)}
+    if term.reroll:
+        # Low results are rolled again once and the second result stands
+        low = term.reroll * face
+        first = {value: (0 if value <= term.reroll else face) + low * face for value in first}
+    if not term.explode:
+        return first
+
+    distribution = {}
+    carried = 0     # total from earlier max results
+    chance = 1.0    # probability that every earlier roll was a max result
+    rolls = first
+    for _ in range(EXPLODE_LIMIT + 1):
+        for value, p in rolls.items():
+            if value != term.sides:
+                distribution[carried + value] = distribution.get(carried + value, 0) + chance * p
+        chance *= rolls[term.sides]
+        carried += term.sides
+        rolls = {value: face for value in range(1, term.sides + 1)}
+        if chance < STATS_TAIL:
+            break
+    distribution[carried] = distribution.get(carried, 0) + chance
+    return distribution
+
+
+def _as_array(distribution):
+    """{value: probability} -> (lowest value, list of probabilities)"""
+    low, high = min(distribution), max(distribution)
+    probabilities = [0.0] * (high - low + 1)
+    for value, p in distribution.items():
+        probabilities[value - low] = p
+    return low, probabilities
+
+
+def _sum_distribution(term, die):
+    """Distribution of the sum of term.count dice, by repeated squaring"""
+    low, probabilities = _as_array(die)
+    width = (len(probabilities) - 1) * term.count + 1
+    if width > STATS_MAX_RANGE:
+        raise DiceError("That roll has too many possible totals for stats mode.")
+
+    if np is None:
+        if term.explode or term.reroll:
+            if width * len(probabilities) * term.count > STATS_MAX_PYTHON_WORK:
+                raise DiceError("That roll is too large for stats mode.")
+        else:
+            # Uniform dice: add one die at a time with a sliding window sum
+            if width * term.count > STATS_MAX_PYTHON_WORK:
+                raise DiceError("That roll is too large for stats mode.")
+            current = [1.0]
+            face = 1 / term.sides
+            for _ in range(term.count):
+                window = 0.0
+                following = []
+                for i in range(len(current) + term.sides - 1):
+                    if i < len(current):
+                        window += current[i]
+                    if i >= term.sides:
+                        window -= current[i - term.sides]
+                    following.append(window * face)
+                current = following
+            return low * term.count, current
+    else:
+        probabilities = np.array(probabilities)
+
+    result = None
+    base = probabilities
+    remaining = term.count
+    while remaining:
+        if remaining & 1:
+            result = base if result is None else _convolve(result, base)
+        remaining >>= 1
+        if remaining:
+            base = _convolve(base, base)
+    return low * term.count, result
+
+
+def _keep_distribution(term, die):
+    """Distribution of a keep/drop term by enumerating every multiset of results"""
+    values = sorted(die)
+    combinations = math.comb(len(values) + term.count - 1, term.count)
+    if combinations > STATS_MAX_COMBINATIONS:
+        raise DiceError("Too many combinations to work out keep/drop odds for that roll.")
+
+    direction, kept = term.keep
+    distribution = {}
+    denominator = math.factorial(term.count)
+    for combination in combinations_with_replacement(values, term.count):
+        # combination is sorted low -> high
+        chosen = combination[len(combination) - kept:] if direction == 'h' else combination[:kept]
+        p = denominator
+        for value, times in Counter(combination).items():
+            p = p / math.factorial(times) * die[value] ** times
+        total = sum(chosen)
+        distribution[total] = distribution.get(total, 0) + p
+    return _as_array(distribution)
+
+
+def distribution(expression):
+    """Exact distribution of one roll of an expression as (lowest total, probabilities)"""
+    low = 0
+    probabilities = [1.0]
+    for term in expression.terms:
+        if isinstance(term, Constant):
+            low += term.sign * term.value
+            continue
+
+        die = _die_distribution(term)
+        if term.keep is not None:
+            term_low, term_probabilities = _keep_distribution(term, die)
+        else:
+            term_low, term_probabilities = _sum_distribution(term, die)
+
+        if term.sign < 0:
+            term_low = -(term_low + len(term_probabilities) - 1)
+            term_probabilities = term_probabilities[::-1]
+        low += term_low
+        probabilities = _convolve(probabilities, term_probabilities)
+
+    return low, probabilities
+
+
+@lru_cache(maxsize=256)
+def stats(expression):
+    """Mean, variance, range, most likely total and percentiles of one roll (cached)"""
+    low, probabilities = distribution(expression)
+    probabilities = list(probabilities)
+    total = sum(probabilities)
+
+    mean = sum((low + i) * p for i, p in enumerate(probabilities)) / total
+    variance = sum((low + i - mean) ** 2 * p for i, p in enumerate(probabilities)) / total
+
+    percentiles = {}
+    wanted = [5, 25, 50, 75, 95]
+    cumulative = 0.0
+    for i, p in enumerate(probabilities):
+        cumulative += p / total
+        while wanted and cumulative >= wanted[0] / 100 - 1e-12:
+            percentiles[wanted.pop(0)] = low + i
+    for percentile in wanted:
+        percentiles[percentile] = low + len(probabilities) - 1
+
+    # The distribution covers every reachable total, except that exploding dice have no
+    # limit in their direction (None)
+    exploding = [term.sign for term in expression.terms if isinstance(term, Dice) and term.explode]
+    most_likely = max(range(len(probabilities)), key=probabilities.__getitem__)
+    return {
+        "mean": mean,
+        "variance": variance,
+        "std_dev": math.sqrt(variance),
+        "min": None if -1 in exploding else low,
+        "max": None if 1 in exploding else low + len(probabilities) - 1,
+        "mode": low + most_likely,
+        "mode_chance": probabilities[most_likely] / total,
+        "percentiles": percentiles,
+    }
@@ -0,0 +1,13 @@
+# Errors shared between the cogs and main.py
+# Kept out of the extension modules: load_extension runs an extension's module afresh,
+# so a class defined there is not the one main.py imported
+from discord.ext import commands
+
+
+class Throttled(commands.CheckFailure):
+    """A command was refused by the rate limiter or by load shedding. notify is False
+    for repeated refusals, which are dropped silently so spam costs no replies"""
+
+    def __init__(self, message, notify):
+        super().__init__(message)
+        self.notify = notify
@@ -1,74 +1,357 @@
+import logging
 import os
+import time
+import asyncio
+import importlib.util
 import httpx
 import discord
+from collections import OrderedDict
 from discord.ext import commands
-from dotenv import load_dotenv
 import random
 
-load_dotenv()
+log = logging.getLogger(__name__)
 
 TENOR_API_KEY = os.getenv('TENOR_API_KEY')
+TENOR_URL = os.getenv('TENOR_URL', 'https://tenor.googleapis.com/v2/search')    # can point at a local stub server
 
-intents = discord.Intents.default()
-intents.members = True
-intents.message_content = True
+# Search results are kept this many seconds, for at most this many distinct terms
+GIF_CACHE_TTL = float(os.getenv('GIF_CACHE_TTL', '600'))
+GIF_CACHE_SIZE = int(os.getenv('GIF_CACHE_SIZE', '500'))
+
+# GIFs fetched per upstream call; picks are served from this pool until it runs out
+GIF_POOL_SIZE = int(os.getenv('GIF_POOL_SIZE', '50'))
+
+# Resilience settings: overall deadline per upstream search, consecutive failures that open
+# the circuit, seconds it stays open, and the delay before a hedged duplicate request is sent
+# (0 disables hedging)
+GIF_DEADLINE = float(os.getenv('GIF_DEADLINE', '3'))
+GIF_BREAKER_FAILURES = int(os.getenv('GIF_BREAKER_FAILURES', '5'))
+GIF_BREAKER_COOLDOWN = float(os.getenv('GIF_BREAKER_COOLDOWN', '30'))
+GIF_HEDGE_DELAY = float(os.getenv('GIF_HEDGE_DELAY', '0'))
+
+# HTTP/2 needs the optional h2 package (pip install httpx[http2])
+HTTP2 = importlib.util.find_spec('h2') is not None
+
+
+class TenorUnavailable(Exception):
+    """Tenor is timing out or failing, or the circuit breaker is open"""
+
+
+class CircuitBreaker():
+    """Opens after too many consecutive upstream failures so requests fail fast, then lets a
+    single trial request through after the cooldown to see whether upstream recovered"""
+
+    def __init__(self, max_failures=GIF_BREAKER_FAILURES, cooldown=GIF_BREAKER_COOLDOWN):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+
+    def allow(self):
+        if self.state == "closed":
+            return True
+        # Open and cooled down, or half open with a trial that never reported back
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = "half_open"
+            self.opened_at = time.monotonic()
+            return True
+        # Open, or half open with the trial request still running
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.max_failures:
+            if self.state != "open":
+                self.times_opened += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+class GifPool():
+    """GIF urls fetched for one term; each pick removes a random url so repeats are rare"""
+
+    def __init__(self, urls, next_pos, ttl):
+        self.urls = urls
+        self.all_urls = tuple(urls)     # kept for serving stale results while Tenor is down
+        self.next_pos = next_pos        # Tenor page token, used to refill with fresh results
+        self.found = bool(urls)         # False when the term has no GIFs at all
+        self.expires_at = time.monotonic() + ttl
+
+    def expired(self):
+        return self.expires_at < time.monotonic()
+
+    def pick(self):
+        # Swap the chosen url with the last one and pop it, O(1)
+        index = random.randrange(len(self.urls))
+        self.urls[index], self.urls[-1] = self.urls[-1], self.urls[index]
+        return self.urls.pop()
+
+
+class SearchCache():
+    """TTL + LRU cache of GIF pools keyed by the normalized search term"""
+
+    def __init__(self, ttl=GIF_CACHE_TTL, max_size=GIF_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()    # term -> GifPool
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(term):
+        return " ".join(term.lower().split())
+
+    def get(self, term):
+        """Return a live pool that still has urls (or knows there are none), else None"""
+        pool = self.entries.get(term)
+        if pool is None or pool.expired() or (pool.found and not pool.urls):
+            self.misses += 1
+            return None
+        self.entries.move_to_end(term)
+        self.hits += 1
+        return pool
+
+    def put(self, term, pool):
+        self.entries[term] = pool
+        self.entries.move_to_end(term)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class TenorClient():
+    """One long-lived, pooled HTTP client for Tenor plus a search result cache.
+    Concurrent searches for the same term share a single upstream request, and a
+    circuit breaker keeps a slow or failing Tenor from tying up commands"""
+
+    def __init__(self):
+        self.client = httpx.AsyncClient(
+            http2=HTTP2,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            timeout=httpx.Timeout(10.0)
+        )
+        self.cache = SearchCache()
+        self.breaker = CircuitBreaker()
+        self.inflight = {}              # term -> task fetching its pool
+        self.coalesced = 0
+        self.hedged = 0
+        self.stale_served = 0
+        self.requests = 0
+        self.total_latency = 0.0
+        self.last_latency = 0.0
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def random_gif(self, search_term):
+        """Return a random GIF url for a search term, or None if there are no results.
+        Raises httpx.HTTPStatusError when Tenor rejects the request and TenorUnavailable
+        when it is down and nothing stale is cached for the term"""
+        term = SearchCache.normalize(search_term)
+
+        pool = self.cache.get(term)
+        while pool is None or (pool.found and not pool.urls):
+            # Another pick may have emptied a freshly fetched pool, so loop until one has urls
+            try:
+                pool = await self.fetch_pool(term)
+            except TenorUnavailable:
+                stale = self.cache.entries.get(term)
+                if stale is None or not stale.all_urls:
+                    raise
+                self.stale_served += 1
+                return random.choice(stale.all_urls)
+
+        return pool.pick() if pool.found else None
+
+    async def fetch_pool(self, term):
+        """Fetch a pool for the term, joining an identical request that is already running"""
+        task = self.inflight.get(term)
+        if task is None:
+            previous = self.cache.entries.get(term)
+            next_pos = previous.next_pos if previous is not None and not previous.expired() else None
+            task = asyncio.get_running_loop().create_task(self.request_pool(term, next_pos))
+            self.inflight[term] = task
+            task.add_done_callback(lambda _: self.inflight.pop(term, None))
+        else:
+            self.coalesced += 1
+
+        # Shield so one caller being cancelled does not cancel the request for everyone
+        return await asyncio.shield(task)
+
+    async def request_pool(self, term, next_pos=None):
+        params = {
+            "q": term,
+            "key": TENOR_API_KEY,
+            "limit": GIF_POOL_SIZE,
+            "contentfilter": "medium"  # Filter out explicit content
+        }
+        if next_pos:
+            params["pos"] = next_pos
+
+        if not self.breaker.allow():
+            raise TenorUnavailable("circuit breaker is open")
+
+        try:
+            response = await asyncio.wait_for(self.hedged_get(params), timeout=GIF_DEADLINE)
+            if response.status_code >= 500 or response.status_code == 429:
+                raise TenorUnavailable(f"Tenor returned status {response.status_code}")
+        except (TenorUnavailable, httpx.TransportError, asyncio.TimeoutError) as e:
+            self.breaker.record_failure()
+            raise TenorUnavailable(str(e) or type(e).__name__) from e
+        except BaseException:
+            # Anything else raised while fetching (cancellation, content decoding, redirects, ...)
+            # must still end a half open trial. The JSON body is parsed after the outcome is recorded
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        response.raise_for_status()
+
+        data = response.json()
+        urls = [result["media_formats"]["gif"]["url"] for result in data.get("results", [])
+                if "gif" in result.get("media_formats", {})]
+        if not urls and next_pos:
+            # Ran past the last page, start over from the first one
+            return await self.request_pool(term)
+
+        pool = GifPool(urls, data.get("next"), self.cache.ttl)
+        self.cache.put(term, pool)
+        return pool
+
+    async def timed_get(self, params):
+        started = time.perf_counter()
+        try:
+            return await self.client.get(TENOR_URL, params=params)
+        finally:
+            self.last_latency = time.perf_counter() - started
+            self.total_latency += self.last_latency
+            self.requests += 1
+
+    async def hedged_get(self, params):
+        """GET from Tenor; if hedging is on and the first request is slow, race a second one"""
+        first = asyncio.ensure_future(self.timed_get(params))
+        if not GIF_HEDGE_DELAY:
+            return await first
+
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=GIF_HEDGE_DELAY)
+            if not done:
+                self.hedged += 1
+                tasks.add(asyncio.ensure_future(self.timed_get(params)))
+
+            # Return the first response; only surface an error once every attempt failed
+            while True:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    tasks.discard(task)
+                    if task.exception() is None:
+                        return task.result()
+                    if not tasks:
+                        raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self):
+        return {
+            "cache_hits": self.cache.hits,
+            "cache_misses": self.cache.misses,
+            "cache_hit_ratio": self.cache.hit_ratio(),
+            "cached_terms": len(self.cache.entries),
+            "coalesced_requests": self.coalesced,
+            "upstream_requests": self.requests,
+            "upstream_avg_latency": self.total_latency / self.requests if self.requests else 0.0,
+            "upstream_last_latency": self.last_latency,
+            "hedged_requests": self.hedged,
+            "stale_served": self.stale_served,
+            "breaker_state": self.breaker.state,
+            "breaker_failures": self.breaker.failures,
+            "breaker_opened": self.breaker.times_opened,
+            "breaker_rejected": self.breaker.rejected,
+        }
 
-bot = commands.Bot(command_prefix='!',intents=intents) 
 
 class Gif(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
+    async def cog_load(self):
+        self.tenor = TenorClient()
+
+    async def cog_unload(self):
+        await self.tenor.close()
+
     # GIF command implementation
-    @bot.command(name='gif')
+    @commands.command(name='gif')
     async def send_gif(self, ctx, *, search_term=None):
         """Send a GIF related to the given search term"""
         if not search_term:
             await ctx.send("Please provide a search term for the GIF!")
             return
-            
+
         # Default to a random GIF if no term is provided
         if not search_term:
             search_term = "random"
-        
+
         try:
-            # Use Tenor API to get GIFs
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    "https://tenor.googleapis.com/v2/search",
-                    params={
-                        "q": search_term,
-                        "key": TENOR_API_KEY,
-                        "limit": 10,
-                        "contentfilter": "medium"  # Filter out explicit content
-                    }
-                )
-                
-                if response.status_code != 200:
-                    await ctx.send(f"Error fetching GIF (Status code: {response.status_code})")
-                    return
-                    
-                data = response.json()
-                
-                if not data.get("results"):
-                    await ctx.send(f"No GIFs found for '{search_term}'")
-                    return
-                    
-                # Get a random GIF from the results
-                gif_choice = random.choice(data["results"])
-                gif_url = gif_choice["media_formats"]["gif"]["url"]
-                
-                # Create an embed with the GIF
-                embed = discord.Embed(color=discord.Color.purple())
-                embed.set_image(url=gif_url)
-                
-                await ctx.send(embed=embed)
-        
+            # Get a random GIF from the Tenor results pooled for this search term
+            try:
+                gif_url = await self.tenor.random_gif(search_term)
+            except httpx.HTTPStatusError as e:
+                await ctx.send(f"Error fetching GIF (Status code: {e.response.status_code})")
+                return
+            except TenorUnavailable:
+                await ctx.send("The GIF service is not responding right now, please try again in a bit.")
+                return
+
+            if not gif_url:
+                await ctx.send(f"No GIFs found for '{search_term}'")
+                return
+
+            # Create an embed with the GIF
+            embed = discord.Embed(color=discord.Color.purple())
+            embed.set_image(url=gif_url)
+
+            await ctx.send(embed=embed)
+
         except Exception as e:
             await ctx.send(f"Error fetching GIF: {str(e)}")
-            print(f"GIF error: {e}")
+            log.exception("GIF error")
+
+    @commands.command(name='gifstats')
+    async def gif_stats(self, ctx):
+        """Show GIF cache, Tenor latency and circuit breaker state"""
+        stats = self.tenor.stats()
+
+        embed = discord.Embed(title="GIF Backend", color=discord.Color.purple())
+        embed.add_field(name="Cache", value=f"Hit ratio: {stats['cache_hit_ratio']:.0%}\n"
+                                            f"Hits: {stats['cache_hits']} / Misses: {stats['cache_misses']}\n"
+                                            f"Cached terms: {stats['cached_terms']}\n"
+                                            f"Coalesced: {stats['coalesced_requests']}", inline=True)
+        embed.add_field(name="Tenor", value=f"Requests: {stats['upstream_requests']}\n"
+                                            f"Avg latency: {stats['upstream_avg_latency'] * 1000:.0f} ms\n"
+                                            f"Last latency: {stats['upstream_last_latency'] * 1000:.0f} ms\n"
+                                            f"Hedged: {stats['hedged_requests']}", inline=True)
+        embed.add_field(name="Circuit Breaker", value=f"State: {stats['breaker_state']}\n"
+                                                      f"Consecutive failures: {stats['breaker_failures']}\n"
+                                                      f"Times opened: {stats['breaker_opened']}\n"
+                                                      f"Rejected: {stats['breaker_rejected']}\n"
+                                                      f"Stale served: {stats['stale_served']}", inline=True)
+
+        await ctx.send(embed=embed)
 
 # function to allow send_gif command to be accessed by main.py
 
 async def setup(bot):
-    await bot.add_cog(Gif(bot))
\ No newline at end of file
+    await bot.add_cog(Gif(bot))
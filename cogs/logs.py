@@ -0,0 +1,136 @@
+# Structured logging: JSON lines written by a background thread
+import os
+import sys
+import copy
+import json
+import time
+import queue
+import logging
+import threading
+import contextvars
+import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+
+# Also write the log to this file (rotated at 10MB, 3 old files kept)
+LOG_FILE = os.getenv('LOG_FILE')
+
+# At most LOG_BURST records per message per LOG_SAMPLE_WINDOW seconds are written,
+# the rest are only counted and reported on the next record that gets through
+LOG_BURST = int(os.getenv('LOG_BURST', '20'))
+LOG_SAMPLE_WINDOW = float(os.getenv('LOG_SAMPLE_WINDOW', '60'))
+
+CONTEXT_FIELDS = ("guild_id", "channel_id", "user_id", "command")
+
+# Context of the command running in the current task, set by bind()
+command_context = contextvars.ContextVar('command_context', default=None)
+
+
+def context(ctx):
+    """Log fields for a command context, for extra= in code that runs outside the command's task"""
+    return {
+        "guild_id": ctx.guild.id if ctx.guild else None,
+        "channel_id": ctx.channel.id if ctx.channel else None,
+        "user_id": ctx.author.id if ctx.author else None,
+        "command": ctx.command.qualified_name if ctx.command else None,
+    }
+
+
+def bind(ctx):
+    """Attach a command's context to every record logged from the current task"""
+    command_context.set(context(ctx))
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        fields = command_context.get()
+        if fields:
+            for field, value in fields.items():
+                if getattr(record, field, None) is None:
+                    setattr(record, field, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Lets the first LOG_BURST records of each message through per window and drops the
+    rest. Messages are told apart by their format string, so log with %s arguments"""
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.windows = {}   # (logger, format string) -> [window start, records seen, records dropped]
+
+    def filter(self, record):
+        key = (record.name, str(record.msg))
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= LOG_SAMPLE_WINDOW:
+                if window is not None and window[2]:
+                    record.suppressed = window[2]
+                if len(self.windows) > 10000:
+                    self.windows.clear()
+                self.windows[key] = [now, 1, 0]
+                return True
+
+            window[1] += 1
+            if window[1] <= LOG_BURST:
+                return True
+            window[2] += 1
+            return False
+
+
+class StructuredQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # Resolve the message and traceback on the logging thread's side of the queue, but
+        # keep them as separate fields instead of QueueHandler's single formatted string
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exception = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS + ("suppressed", "exception"):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, default=str)
+
+
+def setup_logging():
+    """Send every log record through a queue to a writer thread, so logging never
+    blocks the event loop on stdout or disk. Returns the listener to stop on shutdown"""
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if LOG_FILE:
+        handlers.append(RotatingFileHandler(LOG_FILE, maxBytes=10 * 1024 * 1024, backupCount=3))
+    for handler in handlers:
+        handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,300 @@
+# Command latency, event loop lag and storage I/O metrics
+import logging
+import os
+import sys
+import time
+import asyncio
+import threading
+import traceback
+from collections import Counter, deque
+from discord.ext import commands
+import discord
+from .data import Data
+from . import charts
+from . import logs
+
+log = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+# A callback that keeps the event loop busy for longer than this (ms) is reported
+# as a stall together with the stack it was running
+LAG_STALL_MS = float(os.getenv('LAG_STALL_MS', '100'))
+
+# Seconds between event loop heartbeats
+HEARTBEAT_INTERVAL = 0.1
+
+# Heartbeats that recent_lag() looks back over (one second)
+RECENT_BEATS = 10
+
+# Stall stacks kept for !botmetrics
+STALLS_KEPT = 5
+
+# Prometheus text exposition on http://METRICS_HOST:METRICS_PORT/metrics, off when no port is set
+METRICS_PORT = os.getenv('METRICS_PORT')
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+
+class Histogram():
+    """Fixed bucket histogram, cumulative like Prometheus histograms when exported"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[next(i for i, bound in enumerate(self.buckets) if value <= bound)] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of observations"""
+        wanted = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return self.buckets[-1]
+
+    def average(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class LagMonitor():
+    """A heartbeat task on the event loop plus a watchdog thread. When the heartbeat is
+    late by more than LAG_STALL_MS the watchdog grabs the loop thread's current stack,
+    which points at the callback that is blocking it. The rate limiter sheds load on
+    the same lag reading"""
+
+    def __init__(self):
+        self.lag = 0.0
+        self.recent = deque(maxlen=RECENT_BEATS)
+        self.histogram = Histogram()
+        self.stalls = deque(maxlen=STALLS_KEPT)
+        self.stall_count = 0
+        self.heartbeat = time.monotonic()
+        self.loop_thread = None
+        self.task = None
+        self.stopped = threading.Event()
+        self.in_stall = False
+
+    def start(self):
+        self.loop_thread = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.task = asyncio.get_running_loop().create_task(self.beat())
+        threading.Thread(target=self.watch, name='lag-watchdog', daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+
+    async def beat(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+            self.heartbeat = now
+            self.lag = max(0.0, now - started - HEARTBEAT_INTERVAL)
+            self.recent.append(self.lag)
+            self.histogram.observe(self.lag)
+            if self.in_stall:
+                # The stall is over, now its full length is known
+                self.in_stall = False
+                self.stalls[-1]["duration"] = self.lag
+
+    def recent_lag(self):
+        """Worst lag over the last second, steadier than the latest heartbeat alone"""
+        return max(self.recent, default=0.0)
+
+    def watch(self):
+        threshold = LAG_STALL_MS / 1000
+        while not self.stopped.wait(max(threshold / 2, 0.01)):
+            behind = time.monotonic() - self.heartbeat - HEARTBEAT_INTERVAL
+            if behind > threshold and not self.in_stall:
+                frame = sys._current_frames().get(self.loop_thread)
+                if frame is None:
+                    continue
+                # Record first: beat() fills in the duration of stalls[-1] once in_stall is set
+                self.stalls.append({
+                    "at": time.time(),
+                    "duration": None,
+                    "stack": "".join(traceback.format_stack(frame)),
+                })
+                self.stall_count += 1
+                self.in_stall = True
+
+
+def label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+class Metrics(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+
+        # command name -> Histogram of its run time, and (command, error type) -> count
+        self.command_latency = {}
+        self.errors = Counter()
+
+        self.lag_monitor = LagMonitor()
+        self.web_runner = None
+
+    async def cog_load(self):
+        self.bot.before_invoke(self.before_command)
+        self.bot.after_invoke(self.after_command)
+        self.lag_monitor.start()
+        if METRICS_PORT:
+            await self.start_exporter()
+
+    async def cog_unload(self):
+        self.bot._before_invoke = None
+        self.bot._after_invoke = None
+        self.lag_monitor.stop()
+        if self.web_runner is not None:
+            await self.web_runner.cleanup()
+
+    async def before_command(self, ctx):
+        # Runs in the command's own task, so the log context covers everything it logs
+        logs.bind(ctx)
+        # A command behind a lazy-loading placeholder comes through twice, time it from the first
+        if getattr(ctx, 'metrics_started', None) is None:
+            ctx.metrics_started = time.perf_counter()
+
+    async def after_command(self, ctx):
+        started = getattr(ctx, 'metrics_started', None)
+        if started is None or ctx.command is None:
+            return
+        ctx.metrics_started = None
+        name = ctx.command.qualified_name
+        histogram = self.command_latency.get(name)
+        if histogram is None:
+            histogram = self.command_latency[name] = Histogram()
+        histogram.observe(time.perf_counter() - started)
+
+    @commands.Cog.listener()
+    async def on_command_error(self, ctx, error):
+        name = ctx.command.qualified_name if ctx.command else "unknown"
+        self.errors[(name, type(error).__name__)] += 1
+
+    async def start_exporter(self):
+        # aiohttp comes with discord.py
+        from aiohttp import web
+
+        async def handle(request):
+            return web.Response(text=self.exposition(), content_type='text/plain', charset='utf-8')
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        self.web_runner = web.AppRunner(app)
+        await self.web_runner.setup()
+        await web.TCPSite(self.web_runner, METRICS_HOST, int(METRICS_PORT)).start()
+        log.info("Metrics available on http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+
+    def exposition(self):
+        """All metrics in the Prometheus text format"""
+        lines = []
+
+        def histogram(name, help_text, histograms):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, hist in histograms:
+                cumulative = 0
+                for bound, count in zip(hist.buckets, hist.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float('inf') else f"{bound:g}"
+                    lines.append(f'{name}_bucket{{{labels}{"," if labels else ""}le="{le}"}} {cumulative}')
+                braces = f"{{{labels}}}" if labels else ""
+                lines.append(f"{name}_sum{braces} {hist.total}")
+                lines.append(f"{name}_count{braces} {hist.count}")
+
+        def counter(name, help_text, kind, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+
+        histogram("bot_command_duration_seconds", "Time spent running each command.",
+                  [(f'command="{label(name)}"', hist) for name, hist in sorted(self.command_latency.items())])
+        counter("bot_command_errors_total", "Command errors by command and error type.", "counter",
+                [(f'command="{label(name)}",error="{label(error)}"', count) for (name, error), count in sorted(self.errors.items())])
+
+        histogram("bot_event_loop_lag_seconds", "How late the event loop heartbeat woke up.",
+                  [("", self.lag_monitor.histogram)])
+        counter("bot_event_loop_stalls_total", f"Callbacks that blocked the event loop for over {LAG_STALL_MS:g} ms.",
+                "counter", [("", self.lag_monitor.stall_count)])
+
+        counter("bot_storage_operations_total", "Storage operations by type.", "counter",
+                [(f'operation="{op}"', count) for op, (count, _) in sorted(Data.io_stats.items())])
+        counter("bot_storage_seconds_total", "Time spent in storage operations by type.", "counter",
+                [(f'operation="{op}"', seconds) for op, (_, seconds) in sorted(Data.io_stats.items())])
+
+        limiter = self.bot.get_cog('RateLimiter') if self.bot else None
+        if limiter is not None:
+            stats = limiter.stats()
+            counter("bot_commands_allowed_total", "Commands that passed the rate limiter.", "counter",
+                    [("", stats["allowed"])])
+            counter("bot_commands_rejected_total", "Commands refused by the rate limiter or load shedding.", "counter",
+                    [(f'reason="{reason}"', count) for reason, count in sorted(stats["rejected"].items())])
+
+        chart_stats = charts.renderer.stats()
+        counter("bot_charts_rendered_total", "Charts rendered in the worker pool.", "counter",
+                [("", chart_stats["rendered"])])
+        counter("bot_charts_queued", "Charts rendering right now.", "gauge", [("", chart_stats["queued"])])
+
+        return "\n".join(lines) + "\n"
+
+    @commands.command(name='botmetrics')
+    @commands.has_role('admin')
+    async def show_bot_metrics(self, ctx):
+        """Show command latency, event loop lag and storage I/O"""
+        embed = discord.Embed(title="Bot Metrics", color=discord.Color.dark_teal())
+
+        # Busiest commands first
+        busiest = sorted(self.command_latency.items(), key=lambda item: item[1].count, reverse=True)[:10]
+        errors_by_command = Counter()
+        for (name, _), count in self.errors.items():
+            errors_by_command[name] += count
+        embed.add_field(
+            name="Commands (runs, avg, p95)",
+            value="\n".join(f"`{name}` {hist.count}, {hist.average() * 1000:.0f} ms, ≤{hist.percentile(0.95) * 1000:g} ms"
+                            + (f", {errors_by_command[name]} errors" if errors_by_command[name] else "")
+                            for name, hist in busiest) or "No commands yet",
+            inline=False
+        )
+
+        monitor = self.lag_monitor
+        embed.add_field(
+            name="Event loop",
+            value=(f"Lag now: {monitor.lag * 1000:.0f} ms\n"
+                   f"p99 lag: ≤{monitor.histogram.percentile(0.99) * 1000:g} ms\n"
+                   f"Stalls over {LAG_STALL_MS:g} ms: {monitor.stall_count}"),
+            inline=True
+        )
+
+        embed.add_field(
+            name="Storage I/O (ops, total ms)",
+            value="\n".join(f"{op}: {count}, {seconds * 1000:.0f} ms"
+                            for op, (count, seconds) in sorted(Data.io_stats.items())) or "No I/O yet",
+            inline=True
+        )
+
+        if monitor.stalls:
+            stall = monitor.stalls[-1]
+            duration = f"{stall['duration'] * 1000:.0f} ms" if stall["duration"] is not None else "still running"
+            # The innermost frames are the interesting ones
+            stack = stall["stack"][-900:]
+            embed.add_field(
+                name=f"Last stall ({duration}, {time.strftime('%H:%M:%S', time.localtime(stall['at']))})",
+                value=f"```{stack}```",
+                inline=False
+            )
+
+        await ctx.send(embed=embed)
+
+async def setup(bot):
+    await bot.add_cog(Metrics(bot))
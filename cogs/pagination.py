@@ -0,0 +1,163 @@
+# Paginated embeds shared by the list commands (!subs, !events)
+import os
+import time
+from collections import OrderedDict
+import discord
+
+# Records per page, never more than the 25 fields Discord allows in one embed
+PAGE_SIZE = min(int(os.getenv('PAGE_SIZE', '10')), 25)
+
+# Seconds a loaded list and its rendered pages are reused. Mutations invalidate them
+# straight away, the TTL only keeps relative dates ("due in 3 days") fresh
+PAGE_CACHE_TTL = float(os.getenv('PAGE_CACHE_TTL', '60'))
+
+# Lists and pages kept in memory
+PAGE_CACHE_SIZE = int(os.getenv('PAGE_CACHE_SIZE', '256'))
+
+# Seconds the page buttons keep working
+PAGE_VIEW_TIMEOUT = 180
+
+# Discord embed limits
+EMBED_TOTAL_LIMIT = 6000
+TITLE_LIMIT = 256
+DESCRIPTION_LIMIT = 4096
+FIELD_NAME_LIMIT = 256
+FIELD_VALUE_LIMIT = 1024
+
+
+def truncate(text, limit):
+    text = str(text)
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+class Paginator():
+    """Splits a sorted list of records into embed pages. Only the visible page is built,
+    and loaded lists and built pages are cached per scope (a user, or None for a shared
+    list) until invalidate() is called for that scope or the TTL runs out"""
+
+    def __init__(self, title, color, field, footer="", page_size=PAGE_SIZE):
+        self.title = truncate(title, TITLE_LIMIT)
+        self.color = color
+        self.field = field          # record -> (field name, field value)
+        self.footer = footer
+        self.page_size = page_size
+
+        self.versions = {}          # scope -> mutation counter
+        self.lists = OrderedDict()  # scope -> (version, expiry, records, description)
+        self.pages = OrderedDict()  # (scope, page) -> (version, expiry, embed)
+
+    def invalidate(self, scope=None):
+        """Drop cached pages for a scope after its records changed"""
+        self.versions[scope] = self.versions.get(scope, 0) + 1
+
+    @staticmethod
+    def remember(cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        if len(cache) > PAGE_CACHE_SIZE:
+            cache.popitem(last=False)
+
+    async def load(self, scope, loader):
+        """(version, expiry, records, description) for a scope; loader() runs on a cache miss
+        and returns the records, already sorted, and the embed description"""
+        version = self.versions.get(scope, 0)
+        entry = self.lists.get(scope)
+        if entry is None or entry[0] != version or entry[1] <= time.monotonic():
+            records, description = await loader()
+            entry = (version, time.monotonic() + PAGE_CACHE_TTL, records, description)
+            self.remember(self.lists, scope, entry)
+        return entry
+
+    async def page(self, scope, loader, number):
+        """Embed for one page and the page count"""
+        version, expiry, records, description = await self.load(scope, loader)
+        page_count = max(1, -(-len(records) // self.page_size))
+        number = min(max(number, 0), page_count - 1)
+
+        cached = self.pages.get((scope, number))
+        if cached is not None and cached[0] == version and cached[1] == expiry:
+            return cached[2], page_count
+
+        start = number * self.page_size
+        embed = self.build(records[start:start + self.page_size], description, number, page_count)
+        self.remember(self.pages, (scope, number), (version, expiry, embed))
+        return embed, page_count
+
+    def build(self, records, description, number, page_count):
+        description = truncate(description or "", DESCRIPTION_LIMIT)
+        footer = f"Page {number + 1}/{page_count}" + (f" • {self.footer}" if self.footer else "")
+        embed = discord.Embed(title=self.title, description=description or None, color=self.color)
+        embed.set_footer(text=footer)
+
+        # Split what is left of the 6000 character budget evenly between the fields,
+        # so a full page of long records can never exceed it
+        budget = (EMBED_TOTAL_LIMIT - len(self.title) - len(description) - len(footer)) // self.page_size
+        for record in records:
+            name, value = self.field(record)
+            name = truncate(name, min(FIELD_NAME_LIMIT, budget // 4))
+            value = truncate(value, min(FIELD_VALUE_LIMIT, budget - len(name)))
+            embed.add_field(name=name, value=value, inline=False)
+        return embed
+
+    async def send(self, ctx, scope, loader, empty_message):
+        """Send the first page, with page buttons when there is more than one"""
+        _, _, records, _ = await self.load(scope, loader)
+        if not records:
+            await ctx.send(empty_message)
+            return
+
+        embed, page_count = await self.page(scope, loader, 0)
+        if page_count == 1:
+            await ctx.send(embed=embed)
+            return
+
+        view = PageView(self, ctx.author.id, scope, loader, page_count)
+        view.message = await ctx.send(embed=embed, view=view)
+
+
+class PageView(discord.ui.View):
+    """Previous/next buttons for a Paginator message, usable by the member who asked for it"""
+
+    def __init__(self, paginator, author_id, scope, loader, page_count):
+        super().__init__(timeout=PAGE_VIEW_TIMEOUT)
+        self.paginator = paginator
+        self.author_id = author_id
+        self.scope = scope
+        self.loader = loader
+        self.number = 0
+        self.message = None
+        self.update_buttons(page_count)
+
+    def update_buttons(self, page_count):
+        self.previous_page.disabled = self.number == 0
+        self.next_page.disabled = self.number >= page_count - 1
+
+    async def interaction_check(self, interaction):
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message("Run the command yourself to browse these pages.", ephemeral=True)
+            return False
+        return True
+
+    async def show(self, interaction, number):
+        embed, page_count = await self.paginator.page(self.scope, self.loader, number)
+        # The list may have shrunk since the last click
+        self.number = min(number, page_count - 1)
+        self.update_buttons(page_count)
+        await interaction.response.edit_message(embed=embed, view=self)
+
+    @discord.ui.button(label="◀ Previous", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self.show(interaction, self.number - 1)
+
+    @discord.ui.button(label="Next ▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self.show(interaction, self.number + 1)
+
+    async def on_timeout(self):
+        if self.message is not None:
+            self.previous_page.disabled = True
+            self.next_page.disabled = True
+            try:
+                await self.message.edit(view=self)
+            except discord.HTTPException:
+                pass
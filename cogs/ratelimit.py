@@ -0,0 +1,174 @@
+# Rate limiting and load shedding for every command
+import os
+import time
+import asyncio
+from collections import Counter
+from discord.ext import commands
+import discord
+from .errors import Throttled
+
+# Token buckets as name=tokens/seconds: "user", "channel" and "guild" apply to every command,
+# any other name is a command with its own per-user bucket on top of those.
+# e.g. RATE_LIMITS=user=8/20,gif=3/30
+DEFAULT_LIMITS = "user=8/20,channel=20/20,guild=60/20,gif=3/30,stats=3/30,alltime=4/30,subchart=2/30"
+
+
+def parse_limits(text):
+    limits = {}
+    for item in text.split(','):
+        if item.strip():
+            name, limit = item.split('=', 1)
+            tokens, seconds = limit.split('/')
+            limits[name.strip()] = (float(tokens), float(seconds))
+    return limits
+
+
+RATE_LIMITS = {**parse_limits(DEFAULT_LIMITS), **parse_limits(os.getenv('RATE_LIMITS', ''))}
+SCOPES = ("user", "channel", "guild")
+
+# Event loop lag (seconds) above which low priority commands are turned away
+SHED_LAG = float(os.getenv('SHED_LAG', '0.25'))
+
+# Commands that only entertain or report, and can wait while the bot is overloaded
+LOW_PRIORITY = {"gif", "gifstats", "roll", "stats", "alltime", "subchart", "chartstats", "99"}
+
+# Seconds between sweeps of refilled buckets
+SWEEP_INTERVAL = 60
+
+
+class TokenBucket():
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retry_after(self):
+        """Seconds until one token is available (0 when one is available now)"""
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class RateLimiter(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+
+        # (bucket name, id) -> TokenBucket, created on first use
+        self.buckets = {}
+
+        # Users already told they are limited, until their bucket has a token again
+        self.notified = {}
+
+        self.sweep_task = None
+
+        # Counters for !ratestats
+        self.allowed = 0
+        self.rejected = Counter()
+
+    async def cog_load(self):
+        self.sweep_task = asyncio.get_running_loop().create_task(self.sweep_periodically())
+
+    async def cog_unload(self):
+        if self.sweep_task is not None:
+            self.sweep_task.cancel()
+
+    @property
+    def lag(self):
+        """Event loop lag over the last second in seconds, from the metrics cog's heartbeat (0 without it)"""
+        metrics = self.bot.get_cog('Metrics')
+        return metrics.lag_monitor.recent_lag() if metrics is not None else 0.0
+
+    async def sweep_periodically(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            self.sweep()
+
+    def sweep(self):
+        """Drop buckets that have refilled, they behave exactly like new ones"""
+        now = time.monotonic()
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self.buckets[key]
+        self.notified = {user_id: until for user_id, until in self.notified.items() if until > now}
+
+    def bucket(self, name, key):
+        bucket = self.buckets.get((name, key))
+        if bucket is None:
+            capacity, period = RATE_LIMITS[name]
+            bucket = self.buckets[(name, key)] = TokenBucket(capacity, period)
+        return bucket
+
+    def refuse(self, ctx, reason, message, retry_after):
+        self.rejected[reason] += 1
+        now = time.monotonic()
+        notify = self.notified.get(ctx.author.id, 0) <= now
+        if notify:
+            self.notified[ctx.author.id] = now + max(retry_after, 1)
+        raise Throttled(message, notify)
+
+    # A "once" check runs when a command is invoked, not when !help asks whether
+    # each listed command could run, so listing commands costs no tokens
+    async def bot_check_once(self, ctx):
+        """Global check: load shedding first, then every token bucket that applies"""
+        command = ctx.command.qualified_name.split(' ')[0] if ctx.command else None
+
+        if self.lag > SHED_LAG and command in LOW_PRIORITY:
+            self.refuse(ctx, "shed", "The bot is very busy right now, please try that again in a moment.", 5)
+
+        keys = [("user", ctx.author.id), ("channel", ctx.channel.id)]
+        if ctx.guild is not None:
+            keys.append(("guild", ctx.guild.id))
+        if command in RATE_LIMITS and command not in SCOPES:
+            keys.append((command, ctx.author.id))
+
+        # Check every bucket before taking from any, so a refusal costs no tokens
+        now = time.monotonic()
+        buckets = []
+        for name, key in keys:
+            bucket = self.bucket(name, key)
+            bucket.refill(now)
+            wait = bucket.retry_after()
+            if wait:
+                scope = name if name in SCOPES else "command"
+                self.refuse(ctx, scope, f"Slow down! Try again in {wait:.0f}s.", wait)
+            buckets.append(bucket)
+
+        for bucket in buckets:
+            bucket.tokens -= 1
+        self.allowed += 1
+        return True
+
+    def stats(self):
+        return {
+            "allowed": self.allowed,
+            "rejected": dict(self.rejected),
+            "lag": self.lag,
+            "shedding": self.lag > SHED_LAG,
+            "buckets": len(self.buckets),
+        }
+
+    @commands.command(name='ratestats')
+    async def rate_stats(self, ctx):
+        """Show rate limiter and load shedding counters"""
+        stats = self.stats()
+
+        embed = discord.Embed(title="Rate Limiter", color=discord.Color.red())
+        embed.add_field(name="Commands", value=f"Allowed: {stats['allowed']}\n"
+                                               f"Rejected: {sum(stats['rejected'].values())}", inline=True)
+        embed.add_field(name="Rejected by",
+                        value="\n".join(f"{reason}: {count}" for reason, count in sorted(stats['rejected'].items())) or "Nothing yet",
+                        inline=True)
+        embed.add_field(name="Load", value=f"Event loop lag: {stats['lag'] * 1000:.0f} ms\n"
+                                           f"Shedding: {'yes' if stats['shedding'] else 'no'}\n"
+                                           f"Active buckets: {stats['buckets']}", inline=True)
+
+        await ctx.send(embed=embed)
+
+async def setup(bot):
+    await bot.add_cog(RateLimiter(bot))
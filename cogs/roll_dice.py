@@ -1,80 +1,102 @@
 # Dice roller implementation
-import re
+import logging
+import asyncio
 import discord
 from discord.ext import commands
-from dotenv import load_dotenv
-import random
+from . import dice_engine
 
-load_dotenv()
+log = logging.getLogger(__name__)
 
-intents = discord.Intents.default()
-intents.members = True
-intents.message_content = True
-
-bot = commands.Bot(command_prefix='!',intents=intents) 
 
 class DiceRoller(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
-    @bot.command(name='roll')
+    @commands.command(name='roll')
     async def roll_dice(self, ctx, *, dice_notation=None):
-        """Roll dice using standard dice notation (e.g., 2d6+3)"""
+        """Roll dice using dice notation (e.g., 2d6+3, 4d6kh3, 3d6!, 6x4d6kh3)"""
         if not dice_notation:
             # Default to rolling a single d20 if no notation is provided
             dice_notation = "1d20"
         
+        # "!roll stats 2d6+3" shows the odds instead of rolling
+        if dice_notation.lower().startswith("stats "):
+            await self.roll_stats(ctx, dice_notation[len("stats "):].strip())
+            return
+        
         try:
-            # Parse the dice notation with regex
-            # Format: NdS+M where N=number of dice, S=sides per die, M=modifier
-            pattern = r"(\d+)d(\d+)([+-]\d+)?"
-            match = re.match(pattern, dice_notation.lower().replace(" ", ""))
-            
-            if not match:
-                await ctx.send("Invalid dice notation! Please use format like '2d6+3'.")
+            try:
+                expression = dice_engine.parse(dice_notation)
+            except dice_engine.DiceError as e:
+                await ctx.send(str(e))
                 return
-                
-            num_dice = int(match.group(1))
-            sides = int(match.group(2))
-            modifier = match.group(3)
-            mod_value = int(modifier) if modifier else 0
             
-            # Limit the number of dice to prevent abuse
-            if num_dice > 100:
-                await ctx.send("Too many dice! Please roll 100 or fewer.")
-                return
-                
-            if sides > 1000:
-                await ctx.send("Dice too large! Please use dice with 1000 or fewer sides.")
-                return
-            
-            # Roll the dice
-            rolls = [random.randint(1, sides) for _ in range(num_dice)]
-            total = sum(rolls) + mod_value
+            # Very large rolls are evaluated off the event loop
+            dice_count = sum(term.count for term in expression.terms if isinstance(term, dice_engine.Dice))
+            if dice_count * expression.repeat > dice_engine.CHUNK_SIZE:
+                results = await asyncio.to_thread(lambda: [dice_engine.roll_expression(expression) for _ in range(expression.repeat)])
+            else:
+                results = [dice_engine.roll_expression(expression) for _ in range(expression.repeat)]
             
             # Create the response message
-            if num_dice == 1 and mod_value == 0:
-                result_message = f"🎲 You rolled a **{total}**!"
+            single_die = (len(expression.terms) == 1 and isinstance(expression.terms[0], dice_engine.Dice)
+                          and expression.terms[0].count == 1 and not expression.terms[0].explode)
+            if expression.repeat == 1 and single_die:
+                result_message = f"🎲 You rolled a **{results[0][0]}**!"
+            elif expression.repeat == 1:
+                result_message = f"🎲 You rolled {dice_notation}: {dice_engine.describe(results[0][1])} = **{results[0][0]}**"
             else:
-                # Show individual dice for smaller rolls
-                if num_dice <= 10:
-                    dice_results = " + ".join([str(r) for r in rolls])
-                    if mod_value != 0:
-                        mod_sign = "+" if mod_value > 0 else ""
-                        result_message = f"🎲 You rolled {dice_notation}: ({dice_results}) {mod_sign}{mod_value} = **{total}**"
-                    else:
-                        result_message = f"🎲 You rolled {dice_notation}: ({dice_results}) = **{total}**"
-                else:
-                    # For larger rolls, just show the sum of dice
-                    dice_sum = sum(rolls)
-                    mod_sign = "+" if mod_value > 0 else ""
-                    result_message = f"🎲 You rolled {dice_notation}: {dice_sum} {mod_sign}{mod_value} = **{total}**"
+                lines = [f"{i}. {dice_engine.describe(parts)} = **{total}**" for i, (total, parts) in enumerate(results, 1)]
+                result_message = f"🎲 You rolled {dice_notation}:\n" + "\n".join(lines)
+            
+            # Stay under Discord's message limit
+            if len(result_message) > 2000:
+                totals = ", ".join(str(total) for total, _ in results)
+                result_message = f"🎲 You rolled {dice_notation}: **{totals}**"
             
             await ctx.send(result_message)
             
         except Exception as e:
             await ctx.send(f"Error rolling dice: {str(e)}")
-            print(f"Dice rolling error: {e}")
+            log.exception("Dice rolling error")
+
+    async def roll_stats(self, ctx, dice_notation):
+        """Show the exact outcome distribution of a dice expression"""
+        try:
+            try:
+                expression = dice_engine.parse(dice_notation)
+                # Large distributions take a moment, so work them out off the event loop
+                stats = await asyncio.to_thread(dice_engine.stats, expression)
+            except dice_engine.DiceError as e:
+                await ctx.send(str(e))
+                return
+            
+            embed = discord.Embed(
+                title=f"🎲 Odds for {dice_notation}",
+                color=discord.Color.dark_teal()
+            )
+            
+            lowest = "-∞" if stats["min"] is None else stats["min"]
+            highest = "∞" if stats["max"] is None else stats["max"]
+            embed.add_field(name="Average", value=f"{stats['mean']:.2f}", inline=True)
+            embed.add_field(name="Std. Deviation", value=f"{stats['std_dev']:.2f}", inline=True)
+            embed.add_field(name="Variance", value=f"{stats['variance']:.2f}", inline=True)
+            embed.add_field(name="Range", value=f"{lowest} to {highest}", inline=True)
+            embed.add_field(name="Most Likely", value=f"{stats['mode']} ({stats['mode_chance']:.2%})", inline=True)
+            embed.add_field(
+                name="Percentiles",
+                value="\n".join(f"{percentile}%: {value}" for percentile, value in stats["percentiles"].items()),
+                inline=True
+            )
+            
+            if expression.repeat > 1:
+                embed.set_footer(text=f"Odds are for a single roll of the {expression.repeat} repeats")
+            
+            await ctx.send(embed=embed)
+            
+        except Exception as e:
+            await ctx.send(f"Error working out dice odds: {str(e)}")
+            log.exception("Dice stats error")
 
 # function to allow roll_dice command to be accessed by main.py
 
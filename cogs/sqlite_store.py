@@ -0,0 +1,151 @@
+# SQLite storage engine for cogs.data
+import logging
+import os
+import json
+import glob
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+SQLITE_PATH = os.getenv('DATA_SQLITE_PATH', 'data/bot.sqlite3')
+
+# Record fields copied into their own indexed columns so filters and sorts never scan every row
+INDEXED_COLUMNS = ["creator_id", "channel_id", "guild_id", "next_due_date", "datetime"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    collection TEXT NOT NULL,
+    id TEXT NOT NULL,
+    body TEXT NOT NULL,
+    creator_id INTEGER,
+    channel_id INTEGER,
+    guild_id INTEGER,
+    next_due_date TEXT,
+    datetime TEXT,
+    PRIMARY KEY (collection, id)
+);
+CREATE INDEX IF NOT EXISTS idx_records_creator ON records (collection, creator_id);
+CREATE INDEX IF NOT EXISTS idx_records_channel ON records (collection, channel_id);
+CREATE INDEX IF NOT EXISTS idx_records_guild ON records (collection, guild_id);
+CREATE INDEX IF NOT EXISTS idx_records_due ON records (collection, next_due_date);
+CREATE INDEX IF NOT EXISTS idx_records_datetime ON records (collection, datetime);
+"""
+
+
+class SqliteStore():
+    """Keeps collections in one SQLite database. Every statement runs on a single
+    dedicated thread, so the connection is never shared and the event loop never blocks"""
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        self.conn = None
+
+    def _connect(self):
+        # Runs on the sqlite thread, which owns the connection from then on
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.conn = sqlite3.connect(self.path)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(SCHEMA)
+        return self.conn
+
+    @staticmethod
+    def _row(collection, record_id, record):
+        return (collection, record_id, json.dumps(record)) + tuple(record.get(column) for column in INDEXED_COLUMNS)
+
+    def _load(self, collection):
+        rows = self._connect().execute("SELECT id, body FROM records WHERE collection = ?", (collection,))
+        return {record_id: json.loads(body) for record_id, body in rows}
+
+    def _count(self, collection):
+        return self._connect().execute("SELECT COUNT(*) FROM records WHERE collection = ?", (collection,)).fetchone()[0]
+
+    def _apply(self, collection, entries):
+        """Apply journal style entries ({"op", "id", "record"}) in one transaction"""
+        conn = self._connect()
+        with conn:
+            for entry in entries:
+                if entry["op"] == "set":
+                    conn.execute(
+                        f"INSERT OR REPLACE INTO records (collection, id, body, {', '.join(INDEXED_COLUMNS)}) "
+                        f"VALUES (?, ?, ?{', ?' * len(INDEXED_COLUMNS)})",
+                        self._row(collection, entry["id"], entry["record"])
+                    )
+                elif entry["op"] == "delete":
+                    conn.execute("DELETE FROM records WHERE collection = ? AND id = ?", (collection, entry["id"]))
+
+    def rows(self, collection, records):
+        """Encode records into table rows (done by the caller so the live dicts stay on its thread)"""
+        return [self._row(collection, record_id, record) for record_id, record in records.items()]
+
+    def _replace(self, collection, rows):
+        """Replace a whole collection in one transaction"""
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM records WHERE collection = ?", (collection,))
+            conn.executemany(
+                f"INSERT INTO records (collection, id, body, {', '.join(INDEXED_COLUMNS)}) "
+                f"VALUES (?, ?, ?{', ?' * len(INDEXED_COLUMNS)})",
+                rows
+            )
+
+    def _select_ids(self, collection, order_by=None, start=None, filters=None):
+        sql = "SELECT id FROM records WHERE collection = ?"
+        params = [collection]
+        for column, value in (filters or {}).items():
+            if column not in INDEXED_COLUMNS:
+                raise ValueError(f"{column} is not an indexed column")
+            sql += f" AND {column} = ?"
+            params.append(value)
+        if order_by is not None:
+            if order_by not in INDEXED_COLUMNS:
+                raise ValueError(f"{order_by} is not an indexed column")
+            if start is not None:
+                sql += f" AND {order_by} >= ?"
+                params.append(start)
+            sql += f" ORDER BY {order_by}"
+        return [row[0] for row in self._connect().execute(sql, params)]
+
+    # Blocking helpers, only used while loading collections and by the importer
+    def load(self, collection):
+        return self.executor.submit(self._load, collection).result()
+
+    def count(self, collection):
+        return self.executor.submit(self._count, collection).result()
+
+    def replace(self, collection, records):
+        self.executor.submit(self._replace, collection, self.rows(collection, records)).result()
+
+    # Async helpers used from the event loop
+    async def apply(self, loop, collection, entries):
+        await loop.run_in_executor(self.executor, self._apply, collection, entries)
+
+    async def replace_async(self, loop, collection, records):
+        rows = self.rows(collection, records)
+        await loop.run_in_executor(self.executor, self._replace, collection, rows)
+
+    async def select_ids(self, loop, collection, order_by=None, start=None, filters=None):
+        return await loop.run_in_executor(self.executor, self._select_ids, collection, order_by, start, filters)
+
+
+def import_json(store, filenames=None):
+    """One-shot import of data/<name>.json (plus any journal) into SQLite"""
+    from .data import Data
+
+    if filenames is None:
+        filenames = [os.path.basename(path)[:-len('.json')] for path in glob.glob('data/*.json')]
+    for filename in filenames:
+        records = Data._read_file(filename)
+        store.replace(filename, records)
+        Data.retire_files(filename)
+        log.info("Imported %d records from data/%s.json into %s", len(records), filename, store.path)
+
+
+if __name__ == '__main__':
+    # python -m cogs.sqlite_store [collection ...]
+    import sys
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    import_json(SqliteStore(), sys.argv[1:] or None)
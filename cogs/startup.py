@@ -0,0 +1,138 @@
+# Extension loading: startup profiling, concurrent imports and cogs loaded on first use
+import os
+import time
+import asyncio
+import logging
+import importlib
+from discord.ext import commands
+
+log = logging.getLogger(__name__)
+
+# Commands that stand in for each extension that can be deferred, until the first of them is used
+DEFERRABLE = {
+    'cogs.convert_time': ('convert', 'alltime', 'settz', 'guildzones'),
+    'cogs.gif': ('gif', 'gifstats'),
+}
+
+# Third-party libraries that make an extension slow to import. They are imported ahead in
+# worker threads; the cogs.* modules themselves are left to load_extension, which always
+# runs an extension's module afresh. matplotlib is only ever imported by the chart workers
+DEPENDENCIES = {
+    'cogs.gif': ('httpx',),
+    'cogs.convert_time': ('pytz',),
+    'cogs.roll_dice': ('numpy',),
+}
+
+# Extensions loaded on first use instead of at startup (empty = load everything at startup)
+LAZY_EXTENSIONS = [name.strip() for name in os.getenv('LAZY_EXTENSIONS', ','.join(DEFERRABLE)).split(',')
+                   if name.strip() in DEFERRABLE]
+
+
+def import_optional(modules):
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            # Optional (numpy), the extension copes without it
+            pass
+
+
+class StartupProfiler():
+    """Import and setup time of every extension, and the time from start to ready"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.imports = {}       # extension -> seconds importing its DEPENDENCIES
+        self.setups = {}        # extension -> seconds in load_extension (module body and setup)
+        self.ready_after = None
+
+    async def import_dependencies(self, name):
+        # In a worker thread so the imports of different extensions overlap
+        # (the import system locks per module, so this is safe)
+        started = time.perf_counter()
+        await asyncio.to_thread(import_optional, DEPENDENCIES.get(name, ()))
+        self.imports[name] = time.perf_counter() - started
+
+    async def load(self, bot, name):
+        started = time.perf_counter()
+        await bot.load_extension(name)
+        self.setups[name] = time.perf_counter() - started
+
+    def ready(self):
+        self.ready_after = time.perf_counter() - self.started
+        log.info("Ready %.2f s after start", self.ready_after)
+
+    def report(self, elapsed):
+        for name, setup in self.setups.items():
+            log.info("Loaded %s: dependencies %.1f ms, setup %.1f ms",
+                     name, self.imports.get(name, 0) * 1000, setup * 1000)
+        # Less than the sum above, the imports overlap
+        log.info("Extensions loaded in %.1f ms, %.2f s after start (deferred: %s)",
+                 elapsed * 1000, time.perf_counter() - self.started, ", ".join(LAZY_EXTENSIONS) or "none")
+
+
+class LazyExtension():
+    """Placeholder commands that load an extension the first time one of them is used,
+    then run the real command for that same message"""
+
+    def __init__(self, bot, name, profiler):
+        self.bot = bot
+        self.name = name
+        self.profiler = profiler
+        self.loading = None
+
+    def install(self):
+        async def placeholder(ctx):
+            await asyncio.shield(self.load())
+            command = self.bot.get_command(ctx.command.name)
+            # The view is right after the command name, where the real command's arguments start.
+            # Its checks and converters run as usual, the global once-checks already ran
+            ctx.command = command
+            await command.invoke(ctx)
+
+        for command_name in DEFERRABLE[self.name]:
+            self.bot.add_command(commands.Command(placeholder, name=command_name,
+                                                  help="Loads its module on first use, then runs"))
+
+    def uninstall(self):
+        for command_name in DEFERRABLE[self.name]:
+            self.bot.remove_command(command_name)
+
+    def load(self):
+        # Concurrent first uses share one load
+        if self.loading is None:
+            self.loading = asyncio.ensure_future(self._load())
+        return self.loading
+
+    async def _load(self):
+        try:
+            await self.profiler.import_dependencies(self.name)
+            # Nothing awaits between swapping the placeholders out and the real commands in
+            self.uninstall()
+            await self.profiler.load(self.bot, self.name)
+        except Exception:
+            log.exception("Loading %s on first use failed", self.name)
+            if self.name not in self.bot.extensions:
+                self.loading = None
+                if self.bot.get_command(DEFERRABLE[self.name][0]) is None:
+                    self.install()
+            raise
+        log.info("Loaded %s on first use: dependencies %.1f ms, setup %.1f ms", self.name,
+                 self.profiler.imports[self.name] * 1000, self.profiler.setups[self.name] * 1000)
+
+
+async def load_extensions(bot, profiler, core, extensions):
+    """Load core in order, then the other extensions, leaving LAZY_EXTENSIONS for their first use"""
+    started = time.perf_counter()
+    eager = [name for name in core + extensions if name not in LAZY_EXTENSIONS]
+
+    # Third-party imports are the slow part and independent, so they run concurrently.
+    # Setup stays sequential: core must be in place first and add_cog is not worth overlapping
+    await asyncio.gather(*(profiler.import_dependencies(name) for name in eager))
+    for name in eager:
+        await profiler.load(bot, name)
+
+    for name in extensions:
+        if name in LAZY_EXTENSIONS:
+            LazyExtension(bot, name, profiler).install()
+    profiler.report(time.perf_counter() - started)
@@ -1,87 +1,426 @@
 # Server stats implementation
-from discord.ext import commands
+import logging
+import os
+import io
+import time
+import asyncio
+from array import array
+from discord.ext import commands, tasks
 import discord
 from datetime import datetime
+from . import charts
 
-intents = discord.Intents.default()
-intents.members = True
-intents.message_content = True
+log = logging.getLogger(__name__)
+
+# Seconds a rendered !stats embed is reused before it is built again
+STATS_CACHE_TTL = float(os.getenv('STATS_CACHE_TTL', '30'))
+
+# Minutes between full recounts that correct any drift in the live counters
+STATS_RECONCILE_MINUTES = float(os.getenv('STATS_RECONCILE_MINUTES', '15'))
+
+# Seconds between history samples
+STATS_SAMPLE_SECONDS = float(os.getenv('STATS_SAMPLE_SECONDS', '60'))
+
+# Metrics recorded per guild. Gauges are averaged when samples are downsampled,
+# counters (events since the previous sample) are summed
+GAUGES = ("members", "online")
+COUNTERS = ("messages", "commands")
+METRICS = GAUGES + COUNTERS
+
+# History tiers: name -> (seconds per point, points kept). A day of minutes,
+# a month of hours and a year of days, about 100KB per guild
+TIERS = {
+    "minute": (60, 24 * 60),
+    "hour": (3600, 30 * 24),
+    "day": (86400, 365),
+}
+
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+# Points shown by !stats history
+HISTORY_POINTS = 48
+
+
+class GuildCounters():
+    """Member, bot and online counts for one guild, kept current from gateway events"""
+    __slots__ = ("members", "bots", "online")
+
+    def __init__(self, members=()):
+        self.members = 0
+        self.bots = 0
+        self.online = 0
+        for member in members:
+            self.add(member)
+
+    def add(self, member, sign=1):
+        self.members += sign
+        if member.bot:
+            self.bots += sign
+        if member.status != discord.Status.offline:
+            self.online += sign
+
+    def remove(self, member):
+        self.add(member, -1)
+
+    def as_tuple(self):
+        return self.members, self.bots, self.online
+
+
+class Tier():
+    """Fixed-size ring buffer of samples at one resolution. Samples that fall in the same
+    period are folded into one point, and each finished point is passed to the next tier"""
+
+    def __init__(self, span, capacity, next_tier=None):
+        self.span = span
+        self.capacity = capacity
+        self.next_tier = next_tier
+        self.times = array('d', [0.0]) * capacity
+        self.values = {metric: array('d', [0.0]) * capacity for metric in METRICS}
+        self.written = 0
+
+        # Period being filled: its number, the running totals and the sample count
+        self.period = None
+        self.totals = None
+        self.samples = 0
+
+    def add(self, timestamp, sample):
+        period = int(timestamp // self.span)
+        if period != self.period:
+            self.close()
+            self.period = period
+            self.totals = dict.fromkeys(METRICS, 0.0)
+            self.samples = 0
+        for metric in METRICS:
+            self.totals[metric] += sample[metric]
+        self.samples += 1
+
+    def version(self):
+        """Changes whenever a sample is added, used to key rendered charts"""
+        return self.written, self.period, self.samples
+
+    def current(self):
+        """The point for the period being filled"""
+        return {metric: self.totals[metric] / self.samples if metric in GAUGES else self.totals[metric]
+                for metric in METRICS}
+
+    def close(self):
+        if self.period is None:
+            return
+        timestamp = self.period * self.span
+        point = self.current()
+        position = self.written % self.capacity
+        self.times[position] = timestamp
+        for metric in METRICS:
+            self.values[metric][position] = point[metric]
+        self.written += 1
+        if self.next_tier is not None:
+            self.next_tier.add(timestamp, point)
+
+    def points(self, limit):
+        """Up to limit (timestamp, point) pairs, oldest first, including the unfinished period"""
+        stored = min(self.written, self.capacity, limit - 1 if self.period is not None else limit)
+        result = []
+        for offset in range(stored, 0, -1):
+            position = (self.written - offset) % self.capacity
+            result.append((self.times[position], {metric: self.values[metric][position] for metric in METRICS}))
+        if self.period is not None:
+            result.append((self.period * self.span, self.current()))
+        return result
+
+
+class GuildHistory():
+    """Minute, hour and day tiers for one guild; samples go into the minute tier and
+    are downsampled from there"""
+
+    def __init__(self):
+        self.tiers = {}
+        next_tier = None
+        for name, (span, capacity) in reversed(TIERS.items()):
+            next_tier = self.tiers[name] = Tier(span, capacity, next_tier)
+
+    def record(self, timestamp, sample):
+        self.tiers["minute"].add(timestamp, sample)
+
+
+def sparkline(values):
+    low, high = min(values), max(values)
+    if high - low < 1e-9:
+        return SPARK_CHARS[0] * len(values)
+    scale = (len(SPARK_CHARS) - 1) / (high - low)
+    return "".join(SPARK_CHARS[round((value - low) * scale)] for value in values)
 
-bot = commands.Bot(command_prefix='!',intents=intents)
 
 class Stats(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
-    @bot.command(name='stats')
+        # guild id -> GuildCounters
+        self.counters = {}
+
+        # guild id -> (expiry time, embed without the per-request footer)
+        self.embeds = {}
+
+        # guild id -> GuildHistory, plus messages and commands seen since the last sample
+        self.history = {}
+        self.message_counts = {}
+        self.command_counts = {}
+
+    async def cog_load(self):
+        self.sample.start()
+
+    async def cog_unload(self):
+        self.reconcile.cancel()
+        self.sample.cancel()
+
+    def count_guild(self, guild):
+        """Recount a guild from the member cache (O(members), only done on sync and reconcile)"""
+        counters = GuildCounters(guild.members)
+        previous = self.counters.get(guild.id)
+        if previous is not None and previous.as_tuple() != counters.as_tuple():
+            log.info("Stats reconcile: %s counters drifted (members/bots/online %s -> %s)",
+                     guild.name, previous.as_tuple(), counters.as_tuple())
+        self.counters[guild.id] = counters
+        return counters
+
+    def guild_counters(self, guild):
+        counters = self.counters.get(guild.id)
+        if counters is None:
+            counters = self.count_guild(guild)
+        return counters
+
+    @tasks.loop(minutes=STATS_RECONCILE_MINUTES)
+    async def reconcile(self):
+        """Recount every guild; the first run happens as soon as the loop (re)starts"""
+        for guild in self.bot.guilds:
+            self.count_guild(guild)
+            # Let other events run between guilds
+            await asyncio.sleep(0)
+
+    @tasks.loop(seconds=STATS_SAMPLE_SECONDS)
+    async def sample(self):
+        """Record one history sample per guild from the live counters"""
+        now = time.time()
+        for guild in self.bot.guilds:
+            counters = self.guild_counters(guild)
+            history = self.history.get(guild.id)
+            if history is None:
+                history = self.history[guild.id] = GuildHistory()
+            history.record(now, {
+                "members": guild.member_count or counters.members,
+                "online": counters.online,
+                "messages": self.message_counts.pop(guild.id, 0),
+                "commands": self.command_counts.pop(guild.id, 0),
+            })
+
+    @sample.before_loop
+    async def before_sample(self):
+        await self.bot.wait_until_ready()
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        if message.guild is not None:
+            self.message_counts[message.guild.id] = self.message_counts.get(message.guild.id, 0) + 1
+
+    @commands.Cog.listener()
+    async def on_command(self, ctx):
+        if ctx.guild is not None:
+            self.command_counts[ctx.guild.id] = self.command_counts.get(ctx.guild.id, 0) + 1
+
+    # on_ready fires again after a reconnect that could not be resumed. Presence updates
+    # may have been missed in between, so the loop is restarted to recount right away
+    @commands.Cog.listener()
+    async def on_ready(self):
+        self.embeds.clear()
+        if self.reconcile.is_running():
+            self.reconcile.restart()
+        else:
+            self.reconcile.start()
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        self.count_guild(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.counters.pop(guild.id, None)
+        self.embeds.pop(guild.id, None)
+        self.history.pop(guild.id, None)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        counters = self.counters.get(member.guild.id)
+        if counters is not None:
+            counters.add(member)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        counters = self.counters.get(member.guild.id)
+        if counters is not None:
+            counters.remove(member)
+
+    @commands.Cog.listener()
+    async def on_presence_update(self, before, after):
+        counters = self.counters.get(after.guild.id)
+        if counters is not None:
+            was_online = before.status != discord.Status.offline
+            is_online = after.status != discord.Status.offline
+            counters.online += is_online - was_online
+
+    def build_embed(self, guild):
+        """Server statistics embed, built from the live counters"""
+        counters = self.guild_counters(guild)
+
+        # Get server creation date
+        creation_date = guild.created_at
+        days_since_creation = (datetime.now().astimezone() - creation_date).days
+
+        # Count channels by type
+        text_channels = len(guild.text_channels)
+        voice_channels = len(guild.voice_channels)
+        categories = len(guild.categories)
+
+        # Count roles (excluding @everyone)
+        role_count = len(guild.roles) - 1  # -1 to exclude @everyone
+
+        # Get server boost status
+        boost_level = guild.premium_tier
+        boost_count = guild.premium_subscription_count
+
+        # Server features
+        features_list = ", ".join(guild.features) if guild.features else "None"
+
+        # Server verification level
+        verification_level = str(guild.verification_level).title()
+
+        # Create the embed
+        embed = discord.Embed(
+            title=f"{guild.name} Server Statistics",
+            description=f"Server ID: {guild.id}",
+            color=discord.Color.green(),
+            timestamp=datetime.now()
+        )
+
+        # Set the server icon if available
+        if guild.icon:
+            embed.set_thumbnail(url=guild.icon.url)
+
+        # Add server information fields
+        embed.add_field(name="Owner", value=guild.owner.mention if guild.owner else "Unknown", inline=True)
+        embed.add_field(name="Created", value=f"{creation_date.strftime('%B %d, %Y')}\n({days_since_creation} days ago)", inline=True)
+        embed.add_field(name="Region", value=guild.region if hasattr(guild, 'region') else "N/A", inline=True)
+
+        # Member information
+        embed.add_field(
+            name="Members",
+            value=(f"Total: {guild.member_count}\nOnline: {counters.online}\n"
+                   f"Offline: {counters.members - counters.online}\nBots: {counters.bots}"),
+            inline=True
+        )
+        embed.add_field(name="Channels", value=f"📝 Text: {text_channels}\n🔊 Voice: {voice_channels}\n📁 Categories: {categories}", inline=True)
+        embed.add_field(name="Roles", value=role_count, inline=True)
+
+        # Server boost information
+        embed.add_field(name="Boost Status", value=f"Level: {boost_level}\nBoosts: {boost_count}", inline=True)
+        embed.add_field(name="Verification", value=verification_level, inline=True)
+
+        # Features (if not too many)
+        if len(features_list) < 1024:  # Discord embed field value limit
+            embed.add_field(name="Server Features", value=features_list, inline=False)
+
+        return embed
+
+    @commands.group(name='stats', invoke_without_command=True)
+    @commands.guild_only()
     async def server_stats(self, ctx):
         """Display server statistics"""
         try:
             guild = ctx.guild
-            
-            # Calculate the number of online members
-            online_members = sum(1 for member in guild.members if member.status != discord.Status.offline)
-            
-            # Get server creation date
-            creation_date = guild.created_at
-            days_since_creation = (datetime.now().astimezone() - creation_date).days
-            
-            # Count channels by type
-            text_channels = len(guild.text_channels)
-            voice_channels = len(guild.voice_channels)
-            categories = len(guild.categories)
-            
-            # Count roles (excluding @everyone)
-            role_count = len(guild.roles) - 1  # -1 to exclude @everyone
-            
-            # Get server boost status
-            boost_level = guild.premium_tier
-            boost_count = guild.premium_subscription_count
-            
-            # Server features
-            features_list = ", ".join(guild.features) if guild.features else "None"
-            
-            # Server verification level
-            verification_level = str(guild.verification_level).title()
-            
-            # Create the embed
-            embed = discord.Embed(
-                title=f"{guild.name} Server Statistics",
-                description=f"Server ID: {guild.id}",
-                color=discord.Color.green(),
-                timestamp=datetime.now()
-            )
-            
-            # Set the server icon if available
-            if guild.icon:
-                embed.set_thumbnail(url=guild.icon.url)
-            
-            # Add server information fields
-            embed.add_field(name="Owner", value=guild.owner.mention, inline=True)
-            embed.add_field(name="Created", value=f"{creation_date.strftime('%B %d, %Y')}\n({days_since_creation} days ago)", inline=True)
-            embed.add_field(name="Region", value=guild.region if hasattr(guild, 'region') else "N/A", inline=True)
-            
-            # Member information
-            embed.add_field(name="Members", value=f"Total: {guild.member_count}\nOnline: {online_members}", inline=True)
-            embed.add_field(name="Channels", value=f"📝 Text: {text_channels}\n🔊 Voice: {voice_channels}\n📁 Categories: {categories}", inline=True)
-            embed.add_field(name="Roles", value=role_count, inline=True)
-            
-            # Server boost information
-            embed.add_field(name="Boost Status", value=f"Level: {boost_level}\nBoosts: {boost_count}", inline=True)
-            embed.add_field(name="Verification", value=verification_level, inline=True)
-            
-            # Features (if not too many)
-            if len(features_list) < 1024:  # Discord embed field value limit
-                embed.add_field(name="Server Features", value=features_list, inline=False)
-            
+
+            # Reuse the embed rendered in the last STATS_CACHE_TTL seconds
+            cached = self.embeds.get(guild.id)
+            if cached is None or cached[0] <= time.monotonic():
+                cached = (time.monotonic() + STATS_CACHE_TTL, self.build_embed(guild))
+                self.embeds[guild.id] = cached
+            embed = cached[1].copy()
+
             # Add footer with timestamp
             embed.set_footer(text=f"Requested by {ctx.author.name}", icon_url=ctx.author.display_avatar.url)
-            
+
             await ctx.send(embed=embed)
-            
+
         except Exception as e:
             await ctx.send(f"Error displaying server stats: {str(e)}")
-            print(f"Server stats error: {e}")
+            log.exception("Server stats error")
+
+    @server_stats.command(name='history')
+    async def stats_history(self, ctx, resolution="hour"):
+        """Show member and activity trends (resolution: minute, hour or day)"""
+        if resolution not in TIERS:
+            await ctx.send("Please choose a resolution: `!stats history [minute|hour|day]`")
+            return
+
+        history = self.history.get(ctx.guild.id)
+        points = history.tiers[resolution].points(HISTORY_POINTS) if history else []
+        if not points:
+            await ctx.send("No history has been recorded yet, try again in a minute.")
+            return
+
+        first, last = points[0][0], points[-1][0]
+        embed = discord.Embed(
+            title=f"{ctx.guild.name} trends",
+            description=(f"Last {len(points)} {resolution}{'s' if len(points) != 1 else ''}, "
+                         f"{datetime.fromtimestamp(first).strftime('%Y-%m-%d %H:%M')} to "
+                         f"{datetime.fromtimestamp(last).strftime('%Y-%m-%d %H:%M')}"),
+            color=discord.Color.green()
+        )
+
+        for metric in METRICS:
+            values = [point[metric] for _, point in points]
+            if metric in GAUGES:
+                summary = f"{values[0]:,.0f} → {values[-1]:,.0f} ({round(values[-1]) - round(values[0]):+,})"
+            else:
+                summary = f"Total: {sum(values):,.0f}, peak {max(values):,.0f} per {resolution}"
+            embed.add_field(
+                name=metric.title(),
+                value=f"{summary}\n`{sparkline(values)}`",
+                inline=False
+            )
+
+        # Chart image, rendered in the worker pool
+        files = []
+        if charts.HAVE_MATPLOTLIB:
+            tier = history.tiers[resolution]
+            try:
+                image = await charts.renderer.render(
+                    ("stats", ctx.guild.id, resolution, tier.version()),
+                    charts.line_chart,
+                    f"{ctx.guild.name} per {resolution}",
+                    [timestamp for timestamp, _ in points],
+                    {metric.title(): [point[metric] for _, point in points] for metric in METRICS}
+                )
+                files.append(discord.File(io.BytesIO(image), filename="history.png"))
+                embed.set_image(url="attachment://history.png")
+            except charts.ChartBusy:
+                embed.set_footer(text="Chart skipped, the renderer is busy. Try again shortly.")
+
+        await ctx.send(embed=embed, files=files)
+
+    @commands.command(name='chartstats')
+    async def chart_stats(self, ctx):
+        """Show chart renderer queue, cache and timing statistics"""
+        stats = charts.renderer.stats()
+
+        embed = discord.Embed(title="Chart Renderer", color=discord.Color.green())
+        embed.add_field(name="Renders", value=f"Rendered: {stats['rendered']}\n"
+                                              f"Cache hits: {stats['cache_hits']}\n"
+                                              f"Rejected (busy): {stats['rejected']}\n"
+                                              f"Queued now: {stats['queued']}", inline=True)
+        embed.add_field(name="Render time", value="\n".join(f"{label}: {count}" for label, count in stats['histogram']),
+                        inline=True)
+        if not charts.HAVE_MATPLOTLIB:
+            embed.set_footer(text="matplotlib is not installed, charts are disabled")
+
+        await ctx.send(embed=embed)
 
 async def setup(bot):
-    await bot.add_cog(Stats(bot))
\ No newline at end of file
+    await bot.add_cog(Stats(bot))
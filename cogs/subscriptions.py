@@ -1,76 +1,268 @@
 # Subscription tracker implementation
+import logging
+import io
+import asyncio
+import bisect
+import heapq
+import time
 import datetime
 import uuid
-from discord.ext import commands, tasks
+from collections import defaultdict
+from discord.ext import commands
 import discord
 from . import data
+from . import charts
+from .pagination import Paginator
 
-intents = discord.Intents.default()
-intents.members = True
-intents.message_content = True
+log = logging.getLogger(__name__)
 
-bot = commands.Bot(command_prefix='!',intents=intents)
+# Limits for the reminder fan-out: parallel REST user lookups and parallel sends.
+# Rate limited (429) requests are waited out and retried by discord.py itself
+FETCH_CONCURRENCY = 5
+SEND_CONCURRENCY = 5
+
+
+class SubscriptionIndex():
+    """In-memory secondary indexes over the subscriptions collection, kept up to date
+    on every add/delete/renew so commands never scan all subscriptions"""
+
+    def __init__(self):
+        self.by_creator = defaultdict(set)
+        self.by_channel = defaultdict(set)
+        self.by_guild = defaultdict(set)
+        self.by_due = []        # sorted (next_due_date, sub_id) pairs
+        self.entries = {}       # sub_id -> the keys it was indexed under
+
+    def build(self, subscriptions):
+        self.__init__()
+        for sub in subscriptions.values():
+            self.add(sub)
+
+    def add(self, sub):
+        if sub["id"] in self.entries:
+            self.remove(sub["id"])
+
+        keys = (sub["creator_id"], sub["channel_id"], sub.get("guild_id"), sub["next_due_date"])
+        self.entries[sub["id"]] = keys
+        self.by_creator[keys[0]].add(sub["id"])
+        self.by_channel[keys[1]].add(sub["id"])
+        self.by_guild[keys[2]].add(sub["id"])
+        bisect.insort(self.by_due, (keys[3], sub["id"]))
+
+    def remove(self, sub_id):
+        keys = self.entries.pop(sub_id, None)
+        if keys is None:
+            return
+
+        for index, key in ((self.by_creator, keys[0]), (self.by_channel, keys[1]), (self.by_guild, keys[2])):
+            index[key].discard(sub_id)
+            if not index[key]:
+                del index[key]
+        position = bisect.bisect_left(self.by_due, (keys[3], sub_id))
+        if position < len(self.by_due) and self.by_due[position] == (keys[3], sub_id):
+            del self.by_due[position]
+
+    def update(self, sub):
+        """Re-index a subscription after its fields changed (e.g. renewed)"""
+        self.add(sub)
+
+    def for_creator(self, creator_id):
+        """A user's subscriptions sorted by due date"""
+        subscriptions = data.Data.load_data("subscriptions")
+        subs = [subscriptions[sub_id] for sub_id in self.by_creator.get(creator_id, ())]
+        subs.sort(key=lambda sub: sub["next_due_date"])
+        return subs
+
+    def due_between(self, start, end):
+        """Subscriptions with start <= next_due_date <= end, in due date order"""
+        subscriptions = data.Data.load_data("subscriptions")
+        low = bisect.bisect_left(self.by_due, (start.isoformat(),))
+        high = bisect.bisect_right(self.by_due, (end.isoformat(), chr(0x10FFFF)))
+        return [subscriptions[sub_id] for _, sub_id in self.by_due[low:high]]
+
+
+index = SubscriptionIndex()
+
+
+class ReminderScheduler():
+    """Min-heap of (remind_at, sub_id, version) entries. The task sleeps exactly until the
+    earliest reminder and is woken early whenever a subscription is re-armed, so wakeups
+    and memory scale with pending reminders instead of with every stored subscription"""
+
+    # A reminder goes out this long before the due date
+    REMIND_BEFORE = datetime.timedelta(days=3)
+    # Upper bound on one sleep so wall clock changes are picked up
+    MAX_SLEEP = 3600
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.heap = []
+        self.versions = {}      # sub_id -> version of its live heap entry; older entries are stale
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def arm(self, sub):
+        """(Re)schedule the reminder for a subscription, or drop it if none is needed"""
+        due_date = datetime.datetime.fromisoformat(sub["next_due_date"])
+        if sub.get("reminded", False) or due_date < datetime.datetime.now():
+            self.disarm(sub["id"])
+            return
+
+        version = self.versions.get(sub["id"], 0) + 1
+        self.versions[sub["id"]] = version
+        heapq.heappush(self.heap, (due_date - self.REMIND_BEFORE, sub["id"], version))
+        if self.heap[0][1] == sub["id"]:
+            self.wakeup.set()
+
+    def disarm(self, sub_id):
+        # The heap entry is skipped lazily when it reaches the top
+        self.versions.pop(sub_id, None)
+        if len(self.heap) > 2 * len(self.versions) + 64:
+            self.heap = [entry for entry in self.heap if self.versions.get(entry[1]) == entry[2]]
+            heapq.heapify(self.heap)
+
+    def start(self, bot):
+        self.task = asyncio.get_running_loop().create_task(self.run(bot))
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self, bot):
+        await bot.wait_until_ready()
+        subscriptions = data.Data.load_data("subscriptions")
+
+        while True:
+            # Drop entries for subscriptions that were deleted or re-armed
+            while self.heap and self.versions.get(self.heap[0][1]) != self.heap[0][2]:
+                heapq.heappop(self.heap)
+
+            now = datetime.datetime.now()
+            if not self.heap or self.heap[0][0] > now:
+                timeout = self.MAX_SLEEP
+                if self.heap:
+                    timeout = min(timeout, (self.heap[0][0] - now).total_seconds())
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # Collect everything that is due now and hand it over in one batch
+            due = []
+            while self.heap and self.heap[0][0] <= now:
+                remind_at, sub_id, version = heapq.heappop(self.heap)
+                if self.versions.get(sub_id) == version:
+                    del self.versions[sub_id]
+                    if sub_id in subscriptions:
+                        due.append(subscriptions[sub_id])
+            if due:
+                await self.callback(due)
 
 
 class SubscriptionTracker(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        
+        # !subs pages, cached per user until one of their subscriptions changes
+        self.pages = Paginator(
+            "📊 Your Subscription Tracker",
+            discord.Color.blue(),
+            self.subscription_field,
+            footer="Use !delsub [ID] to remove a subscription"
+        )
+
+    async def cog_load(self):
+        # Arm every upcoming, not yet reminded subscription and start the scheduler
+        self.reminders = ReminderScheduler(self.send_reminders)
+        for sub in index.due_between(datetime.datetime.now(), datetime.datetime.max):
+            self.reminders.arm(sub)
+        self.reminders.start(self.bot)
 
-    # Task to check for upcoming subscription payments
-    @tasks.loop(hours=24)
-    async def check_subscriptions():
-        """Check for subscriptions due within the next 3 days and send reminders"""
+    async def cog_unload(self):
+        self.reminders.stop()
+
+    async def send_reminders(self, subs):
+        """Send payment reminders for subscriptions whose reminder time has come"""
         try:
-            subscriptions = data.Data.load_data("subscriptions")
-            if not subscriptions:
-                print("No subscriptions found.")
-                return
-                
+            started = time.perf_counter()
             now = datetime.datetime.now()
-            three_days_later = now + datetime.timedelta(days=3)
             
-            # Find subscriptions due in the next 3 days
-            for sub_id, sub in subscriptions.items():
-                # Parse the due date
+            # Mark every reminder in the batch as sent with one write
+            for sub in subs:
+                sub["reminded"] = True
+            data.Data.update_records("subscriptions", {sub["id"]: sub for sub in subs})
+            
+            users = await self.resolve_users({sub["creator_id"] for sub in subs})
+            resolved = time.perf_counter()
+            
+            messages = []
+            for sub in subs:
+                channel = self.bot.get_channel(sub["channel_id"])
+                if not channel:
+                    continue
+                
                 due_date = datetime.datetime.fromisoformat(sub["next_due_date"])
+                days_until_due = (due_date - now).days
+                
+                embed = discord.Embed(
+                    title="💰 Subscription Payment Due Soon",
+                    description=f"Your subscription to **{sub['name']}** is due in {days_until_due} days!",
+                    color=discord.Color.orange()
+                )
+                
+                embed.add_field(name="Amount", value=f"${sub['amount']:.2f}", inline=True)
+                embed.add_field(name="Due Date", value=due_date.strftime("%B %d, %Y"), inline=True)
                 
-                # Check if it's due within the next 3 days and hasn't been reminded
-                if now <= due_date <= three_days_later and not sub.get("reminded", False):
-                    # Mark as reminded
-                    sub["reminded"] = True
-                    data.Data.save_data(subscriptions, "subscriptions")
-                    
-                    # Send reminder
-                    channel_id = sub["channel_id"]
-                    channel = bot.get_channel(channel_id)
-                    
-                    if channel:
-                        days_until_due = (due_date - now).days
-                        
-                        embed = discord.Embed(
-                            title="💰 Subscription Payment Due Soon",
-                            description=f"Your subscription to **{sub['name']}** is due in {days_until_due} days!",
-                            color=discord.Color.orange()
-                        )
-                        
-                        embed.add_field(name="Amount", value=f"${sub['amount']:.2f}", inline=True)
-                        embed.add_field(name="Due Date", value=due_date.strftime("%B %d, %Y"), inline=True)
-                        
-                        user = await bot.fetch_user(sub["creator_id"])
-                        if user:
-                            await channel.send(content=f"{user.mention}", embed=embed)
-                        else:
-                            await channel.send(embed=embed)
+                user = users.get(sub["creator_id"])
+                messages.append((channel, user.mention if user else None, embed))
+            
+            # Send through a concurrency limited dispatcher
+            semaphore = asyncio.Semaphore(SEND_CONCURRENCY)
+            results = await asyncio.gather(*(self.send_limited(semaphore, *message) for message in messages))
+            finished = time.perf_counter()
+            
+            log.info("Subscription reminders: %d/%d sent, users resolved in %.2fs, sent in %.2fs, total %.2fs",
+                     sum(results), len(subs), resolved - started, finished - resolved, finished - started)
         
-        except Exception as e:
-            print(f"Check subscriptions error: {e}")
+        except Exception:
+            log.exception("Check subscriptions error")
 
-    @check_subscriptions.before_loop
-    async def before_check_subscriptions():
-        """Wait until the bot is ready before starting the subscription check loop"""
-        await bot.wait_until_ready()
+    async def resolve_users(self, user_ids):
+        """Look users up in the member cache and fetch only the missing ones, a few at a time"""
+        users = {}
+        missing = []
+        for user_id in user_ids:
+            user = self.bot.get_user(user_id)
+            if user:
+                users[user_id] = user
+            else:
+                missing.append(user_id)
+        
+        semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+        
+        async def fetch(user_id):
+            async with semaphore:
+                try:
+                    users[user_id] = await self.bot.fetch_user(user_id)
+                except discord.HTTPException:
+                    pass
+        
+        await asyncio.gather(*(fetch(user_id) for user_id in missing))
+        return users
+
+    async def send_limited(self, semaphore, channel, content, embed):
+        """Send one reminder, at most SEND_CONCURRENCY at a time"""
+        async with semaphore:
+            try:
+                await channel.send(content=content, embed=embed)
+                return True
+            except discord.HTTPException as e:
+                log.warning("Subscription reminder error: %s", e)
+                return False
 
-    @bot.command(name='addsub')
+    @commands.command(name='addsub')
     async def add_subscription(self, ctx, name=None, amount=None, due_date_str=None, *, notes=""):
         """Add a subscription to track"""
         if not all([name, amount, due_date_str]):
@@ -105,19 +297,15 @@ class SubscriptionTracker(commands.Cog):
                 "creator_id": ctx.author.id,
                 "creator_name": ctx.author.name,
                 "channel_id": ctx.channel.id,
+                "guild_id": ctx.guild.id if ctx.guild else None,
                 "reminded": False
             }
             
-            # Load existing subscriptions
-            subscriptions = data.Data.load_data("subscriptions")
-            if not subscriptions:
-                subscriptions = {}
-                
-            # Add new subscription
-            subscriptions[sub_id] = subscription
-            
-            # Save updated subscriptions
-            data.Data.save_data(subscriptions, "subscriptions")
+            # Add new subscription and save it
+            data.Data.update_record("subscriptions", sub_id, subscription)
+            index.add(subscription)
+            self.pages.invalidate(ctx.author.id)
+            self.reminders.arm(subscription)
             
             # Create confirmation embed
             embed = discord.Embed(
@@ -139,78 +327,94 @@ class SubscriptionTracker(commands.Cog):
             
         except Exception as e:
             await ctx.send(f"Error adding subscription: {str(e)}")
-            print(f"Add subscription error: {e}")
+            log.exception("Add subscription error")
 
-    @bot.command(name='subs')
+    def subscription_field(self, sub):
+        """Embed field for one subscription in !subs"""
+        due_date = datetime.datetime.fromisoformat(sub["next_due_date"])
+        
+        # Format the due date
+        formatted_date = due_date.strftime("%B %d, %Y")
+        
+        # Calculate days until due
+        days_until_due = (due_date - datetime.datetime.now()).days
+        if days_until_due < 0:
+            due_status = "❗ **OVERDUE**"
+        elif days_until_due == 0:
+            due_status = "⚠️ **DUE TODAY**"
+        else:
+            due_status = f"Due in {days_until_due} days"
+            
+        # Format the subscription info
+        value = f"💵 Amount: **${sub['amount']:.2f}**\n📅 Due: {formatted_date} ({due_status})"
+            
+        if sub["notes"]:
+            value += f"\n📝 Notes: {sub['notes']}"
+        
+        return f"{sub['name']} (ID: {sub['id']})", value
+
+    @commands.command(name='subs')
     async def list_subscriptions(self, ctx):
         """List all active subscriptions"""
         try:
-            subscriptions = data.Data.load_data("subscriptions")
-            
-            if not subscriptions:
+            if not index.entries:
                 await ctx.send("No subscriptions are currently being tracked!")
                 return
-                
-            # Filter subscriptions for this user
-            user_subs = {sub_id: sub for sub_id, sub in subscriptions.items() 
-                        if sub["creator_id"] == ctx.author.id}
             
-            if not user_subs:
-                await ctx.send("You don't have any subscriptions being tracked!")
-                return
+            async def load():
+                # Subscriptions for this user, already sorted by due date
+                user_subs = index.for_creator(ctx.author.id)
                 
-            # Get total monthly cost
-            total_monthly_cost = sum(sub["amount"] for sub in user_subs.values())
+                # Get total monthly cost
+                total_monthly_cost = sum(sub["amount"] for sub in user_subs)
+                return user_subs, f"Total monthly cost: **${total_monthly_cost:.2f}**"
             
-            # Sort subscriptions by due date
-            sorted_subs = []
-            for sub_id, sub in user_subs.items():
-                due_date = datetime.datetime.fromisoformat(sub["next_due_date"])
-                sorted_subs.append((due_date, sub))
-                
-            sorted_subs.sort(key=lambda x: x[0])
+            await self.pages.send(ctx, ctx.author.id, load, "You don't have any subscriptions being tracked!")
+            
+        except Exception as e:
+            await ctx.send(f"Error listing subscriptions: {str(e)}")
+            log.exception("List subscriptions error")
+
+    @commands.command(name='subchart')
+    async def subscription_chart(self, ctx):
+        """Show a chart of your monthly subscription spending"""
+        user_subs = index.for_creator(ctx.author.id)
+        if not user_subs:
+            await ctx.send("You don't have any subscriptions being tracked!")
+            return
+        if not charts.HAVE_MATPLOTLIB:
+            await ctx.send("Charts are not available on this bot (matplotlib is not installed). Use `!subs` instead.")
+            return
+        
+        try:
+            user_subs = sorted(user_subs, key=lambda sub: sub["amount"], reverse=True)
+            total_monthly_cost = sum(sub["amount"] for sub in user_subs)
+            
+            # The key holds everything the chart shows, so any edit renders a new one
+            image = await charts.renderer.render(
+                ("subs", ctx.author.id, tuple((sub["id"], sub["name"], sub["amount"]) for sub in user_subs)),
+                charts.bar_chart,
+                f"Monthly spending: ${total_monthly_cost:.2f}",
+                [sub["name"] for sub in user_subs],
+                [sub["amount"] for sub in user_subs],
+                "$ per month"
+            )
             
-            # Create an embed to display subscriptions
             embed = discord.Embed(
-                title="📊 Your Subscription Tracker",
-                description=f"Total monthly cost: **${total_monthly_cost:.2f}**",
+                title="📊 Your Subscription Spending",
+                description=f"Total monthly cost: **${total_monthly_cost:.2f}** across {len(user_subs)} subscriptions",
                 color=discord.Color.blue()
             )
+            embed.set_image(url="attachment://subscriptions.png")
+            await ctx.send(embed=embed, file=discord.File(io.BytesIO(image), filename="subscriptions.png"))
             
-            for due_date, sub in sorted_subs:
-                # Format the due date
-                formatted_date = due_date.strftime("%B %d, %Y")
-                
-                # Calculate days until due
-                days_until_due = (due_date - datetime.datetime.now()).days
-                if days_until_due < 0:
-                    due_status = "❗ **OVERDUE**"
-                elif days_until_due == 0:
-                    due_status = "⚠️ **DUE TODAY**"
-                else:
-                    due_status = f"Due in {days_until_due} days"
-                    
-                # Format the subscription info
-                value = f"💵 Amount: **${sub['amount']:.2f}**\n📅 Due: {formatted_date} ({due_status})"
-                    
-                if sub["notes"]:
-                    value += f"\n📝 Notes: {sub['notes']}"
-                    
-                embed.add_field(
-                    name=f"{sub['name']} (ID: {sub['id']})",
-                    value=value,
-                    inline=False
-                )
-                
-            embed.set_footer(text="Use !delsub [ID] to remove a subscription")
-            
-            await ctx.send(embed=embed)
-            
+        except charts.ChartBusy:
+            await ctx.send("The chart renderer is busy, please try again in a few seconds.")
         except Exception as e:
-            await ctx.send(f"Error listing subscriptions: {str(e)}")
-            print(f"List subscriptions error: {e}")
+            await ctx.send(f"Error drawing subscription chart: {str(e)}")
+            log.exception("Subscription chart error")
 
-    @bot.command(name='delsub')
+    @commands.command(name='delsub')
     async def delete_subscription(self, ctx, sub_id=None):
         """Delete a subscription by its ID"""
         if not sub_id:
@@ -233,16 +437,18 @@ class SubscriptionTracker(commands.Cog):
                 
             # Remove the subscription
             sub_name = sub["name"]
-            del subscriptions[sub_id]
-            data.Data.save_data(subscriptions, "subscriptions")
+            data.Data.delete_record("subscriptions", sub_id)
+            index.remove(sub_id)
+            self.pages.invalidate(sub["creator_id"])
+            self.reminders.disarm(sub_id)
             
             await ctx.send(f"Subscription **{sub_name}** has been deleted from your tracker!")
             
         except Exception as e:
             await ctx.send(f"Error deleting subscription: {str(e)}")
-            print(f"Delete subscription error: {e}")
+            log.exception("Delete subscription error")
 
-    @bot.command(name='renewsub')
+    @commands.command(name='renewsub')
     async def renew_subscription(self, ctx, sub_id=None):
         """Mark a subscription as paid and update the next due date"""
         if not sub_id:
@@ -287,7 +493,10 @@ class SubscriptionTracker(commands.Cog):
             # Update the subscription
             sub["next_due_date"] = next_due_date.isoformat()
             sub["reminded"] = False
-            data.Data.save_data(subscriptions, "subscriptions")
+            data.Data.update_record("subscriptions", sub_id, sub)
+            index.update(sub)
+            self.pages.invalidate(sub["creator_id"])
+            self.reminders.arm(sub)
             
             # Create confirmation embed
             embed = discord.Embed(
@@ -303,7 +512,8 @@ class SubscriptionTracker(commands.Cog):
             
         except Exception as e:
             await ctx.send(f"Error renewing subscription: {str(e)}")
-            print(f"Renew subscription error: {e}")
+            log.exception("Renew subscription error")
 
 async def setup(bot):
+    index.build(data.Data.load_data("subscriptions"))
     await bot.add_cog(SubscriptionTracker(bot))
\ No newline at end of file
@@ -0,0 +1,132 @@
+# Timezone name resolver used by the time conversion commands
+import re
+from collections import Counter
+from functools import lru_cache
+import pytz
+
+# Common abbreviations and names that are not (or not usefully) pytz zone names.
+# These win over pytz's fixed-offset zones of the same name, e.g. EST means US/Eastern
+ALIASES = {
+    "utc": "UTC", "gmt": "Etc/GMT", "z": "UTC",
+    "et": "US/Eastern", "est": "US/Eastern", "edt": "US/Eastern", "eastern": "US/Eastern",
+    "ct": "US/Central", "cst": "US/Central", "cdt": "US/Central", "central": "US/Central",
+    "mt": "US/Mountain", "mst": "US/Mountain", "mdt": "US/Mountain", "mountain": "US/Mountain",
+    "pt": "US/Pacific", "pst": "US/Pacific", "pdt": "US/Pacific", "pacific": "US/Pacific",
+    "akst": "US/Alaska", "hst": "US/Hawaii",
+    "bst": "Europe/London", "uk": "Europe/London", "wet": "Europe/Lisbon",
+    "cet": "Europe/Paris", "cest": "Europe/Paris",
+    "eet": "Europe/Athens", "eest": "Europe/Athens", "greece": "Europe/Athens",
+    "msk": "Europe/Moscow", "ist": "Asia/Kolkata", "india": "Asia/Kolkata",
+    "gst": "Asia/Dubai", "sgt": "Asia/Singapore", "hkt": "Asia/Hong_Kong",
+    "jst": "Asia/Tokyo", "japan": "Asia/Tokyo", "kst": "Asia/Seoul",
+    "aest": "Australia/Sydney", "aedt": "Australia/Sydney", "awst": "Australia/Perth",
+    "nzst": "Pacific/Auckland", "nzdt": "Pacific/Auckland",
+    "san francisco": "America/Los_Angeles", "seattle": "America/Los_Angeles",
+    "washington": "America/New_York", "boston": "America/New_York", "miami": "America/New_York",
+    "texas": "America/Chicago", "dallas": "America/Chicago", "houston": "America/Chicago",
+    "beijing": "Asia/Shanghai", "china": "Asia/Shanghai", "mumbai": "Asia/Kolkata",
+    "delhi": "Asia/Kolkata", "new delhi": "Asia/Kolkata", "thessaloniki": "Europe/Athens",
+}
+
+# Queries shorter than this are only matched exactly (abbreviations are too ambiguous)
+MIN_FUZZY_LENGTH = 4
+
+# Candidates kept from the trigram index before computing edit distances
+CANDIDATES = 25
+
+
+def normalize(text):
+    """Lowercase, treat underscores as spaces and collapse whitespace"""
+    return re.sub(r"\s+", " ", text.replace("_", " ").strip().lower())
+
+
+def trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b, limit):
+    """Edit distance between a and b counting a swap of neighbouring characters as one edit,
+    or limit + 1 once it is known to exceed limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before = None
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            cost = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b))
+            if before is not None and j > 1 and char_a == b[j - 2] and a[i - 2] == char_b:
+                cost = min(cost, before[j - 2] + 1)
+            current.append(cost)
+        if min(current) > limit:
+            return limit + 1
+        before, previous = previous, current
+    return previous[-1]
+
+
+class TimezoneResolver():
+    """Resolves user input ("EST", "new york", "Europe/Athen") to a pytz zone name.
+    Exact keys are a dict lookup; typos go through a trigram index, then edit distance"""
+
+    def __init__(self):
+        # Normalized key -> zone name
+        self.keys = {}
+
+        # Canonical zones first, so e.g. "athens" maps to Europe/Athens rather than a link name
+        for zone in list(pytz.common_timezones) + list(pytz.all_timezones):
+            name = normalize(zone)
+            self.keys.setdefault(name, zone)
+            self.keys.setdefault(name.split("/")[-1], zone)
+        self.keys.update(ALIASES)
+
+        # Trigram -> indexes into key_list
+        self.key_list = list(self.keys)
+        self.index = {}
+        for position, key in enumerate(self.key_list):
+            for gram in trigrams(key):
+                self.index.setdefault(gram, []).append(position)
+
+        # Per instance, so the cache goes away with the resolver instead of pinning it
+        self.resolve = lru_cache(maxsize=1024)(self._resolve)
+
+    def candidates(self, query, limit):
+        """(edit distance, key) pairs, closest first, for the keys that share the most
+        trigrams with query. Distances above limit are reported as limit + 1"""
+        shared = Counter()
+        for gram in trigrams(query):
+            shared.update(self.index.get(gram, ()))
+
+        ranked = []
+        for position, _ in shared.most_common(CANDIDATES):
+            key = self.key_list[position]
+            ranked.append((edit_distance(query, key, limit), key))
+        ranked.sort()
+        return ranked
+
+    def _resolve(self, text):
+        """Return the zone name for text, or None if nothing is close enough"""
+        query = normalize(text)
+        if query in self.keys:
+            return self.keys[query]
+        if len(query) < MIN_FUZZY_LENGTH:
+            return None
+
+        # Allow roughly one typo per four characters
+        allowed = max(1, len(query) // 4)
+        ranked = self.candidates(query, allowed)
+        if ranked and ranked[0][0] <= allowed:
+            return self.keys[ranked[0][1]]
+        return None
+
+    def suggest(self, text, limit=3):
+        """Closest zone names for text, best first"""
+        suggestions = []
+        query = normalize(text)
+        for _, key in self.candidates(query, max(len(query), 1)):
+            zone = self.keys[key]
+            if zone not in suggestions:
+                suggestions.append(zone)
+            if len(suggestions) == limit:
+                break
+        return suggestions
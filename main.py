@@ -1,6 +1,7 @@
 # bot.py
 import os
 import random
+import logging
 import discord
 import asyncio
 from discord.ext import commands
@@ -9,9 +10,16 @@ from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.jobstores.base import JobLookupError
 
+load_dotenv()                           #loads the .env file, before the cogs read their settings from it
 
+from cogs.data import Data
+from cogs.charts import renderer
+from cogs.errors import Throttled
+from cogs.startup import StartupProfiler, load_extensions
+from cogs import logs
+
+profiler = StartupProfiler()
 
-load_dotenv()                           #loads the .env file and gets the values below
 TOKEN = os.getenv('DISCORD_TOKEN')
 GUILD = os.getenv('DISCORD_GUILD')
 
@@ -22,10 +30,12 @@ intents.presences = True
 
 bot = commands.Bot(command_prefix='!',intents=intents)      #sets the prefix for bot commands, can be set to almost anything
 
+# Scheduled jobs (event reminders) live in a SQLite job store next to the data files
+# so they survive restarts
+JOBSTORE_URL = os.getenv('EVENT_JOBSTORE_URL', 'sqlite:///data/jobs.sqlite3')
+
+log = logging.getLogger('bot')
 
-@bot.event
-async def on_ready():
-    print(f'{bot.user.name} has connected to Discord!')
 
 @bot.event
 async def on_member_join(member):                #when a new member joins sends a dm welcoming them
@@ -34,19 +44,6 @@ async def on_member_join(member):                #when a new member joins sends
         f'Hi {member.name}, welcome to my Discord server!'
     )
 
-@bot.event
-async def on_ready():
-    
-    guild = discord.utils.get(bot.guilds, name=GUILD)        #loop through data discord sent about guilds
-
-    print(
-        f'{bot.user} has connected to the following Guild:\n'
-        f'{guild.name}(id: {guild.id})'
-        )
-    
-    members = '\n - '.join([member.name for member in guild.members])
-    print(f'Guild Members:\n - {members}')
-
 @bot.command(name='99', help='Responds with a random quote from Brooklyn 99')
 async def nine_nine(ctx):
     
@@ -68,28 +65,28 @@ async def create_channel(ctx, channel_name='real-python'):
     guild = ctx.guild
     existing_channel = discord.utils.get(guild.channels, name=channel_name)
     if not existing_channel:
-        print(f'Creating a new channel: {channel_name}')
+        log.info('Creating a new channel: %s', channel_name)
         await guild.create_text_channel(channel_name)
 
-@bot.event
-async def on_command_error(ctx, error):
-    if isinstance(error, commands.errors.CheckFailure):
-        await ctx.send('You do not have the correct role for this command.')
-
-
 # Bot ready event
+# on_ready fires again after every gateway reconnect, so one-time work is guarded
+# and schedulers/loops are started once in main() and the cogs' cog_load instead
 @bot.event
 async def on_ready():
     
-    import cogs.subscriptions as sub
-    print(f'{bot.user.name} has connected to Discord!')
+    log.info('%s has connected to Discord!', bot.user.name)
     
-    # Create scheduler for calendar events
-    bot.scheduler = AsyncIOScheduler()
-    bot.scheduler.start()
-    
-    # Start task to check for upcoming subscriptions
-    sub.check_subscriptions.start()
+    if not getattr(bot, 'ready_once', False):
+        bot.ready_once = True
+        profiler.ready()
+        bot.scheduler.resume()      # persisted jobs run from here on, with every cog loaded
+        
+        guild = discord.utils.get(bot.guilds, name=GUILD)        #loop through data discord sent about guilds
+        if guild:
+            # A count instead of the member list, which is huge for big guilds
+            log.info('%s has connected to guild %s (id: %s) with %s members',
+                     bot.user, guild.name, guild.id, guild.member_count)
+        log.info('Serving %d guilds', len(bot.guilds))
     
     # Set bot status
     await bot.change_presence(activity=discord.Activity(
@@ -100,13 +97,18 @@ async def on_ready():
 # Error handling
 @bot.event
 async def on_command_error(ctx, error):
-    if isinstance(error, commands.CommandNotFound):
+    if isinstance(error, Throttled):
+        if error.notify:            # only the first refusal gets a reply
+            await ctx.send(str(error))
+    elif isinstance(error, commands.errors.CheckFailure):
+        await ctx.send('You do not have the correct role for this command.')
+    elif isinstance(error, commands.CommandNotFound):
         await ctx.send("Command not found. Try `!help` to see all available commands.")
     elif isinstance(error, commands.MissingRequiredArgument):
         await ctx.send(f"Missing required argument: {error.param.name}")
     else:
         await ctx.send(f"An error occurred: {error}")
-        print(f"Error: {error}")
+        log.error("Command error: %s", error, exc_info=error, extra=logs.context(ctx))
 
 # Help command
 @bot.command(name='devhelp')
@@ -119,26 +121,35 @@ async def custom_help(ctx):
     
     help_embed.add_field(
         name="GIF Commands",
-        value="!gif [search term] - Send a GIF related to your search term",
+        value=("!gif [search term] - Send a GIF related to your search term\n"
+               "!gifstats - Show GIF cache and Tenor latency statistics"),
         inline=False
     )
     
     help_embed.add_field(
         name="Dice Commands",
-        value="!roll [dice notation] - Roll dice (e.g., !roll 2d6+3)",
+        value=("!roll [dice notation] - Roll dice (e.g., !roll 2d6+3)\n"
+               "Also: 2d6+1d8+3, 4d6kh3 / 4d6dl1 (keep/drop), 3d6! (explode), 2d20r1 (reroll), 6x4d6kh3 (repeat)\n"
+               "!roll stats [dice notation] - Show the odds of a roll"),
         inline=False
     )
     
     help_embed.add_field(
         name="Time Commands",
         value=("!convert [time] [from_tz] [to_tz] - Convert time between timezones\n"
-               "!alltime [time] [from_tz] - Show time in all major timezones"),
+               "!alltime [time] [from_tz] - Show time in all major timezones\n"
+               "!settz [timezone] - Save your timezone, then from_tz can be left out\n"
+               "!guildzones - Show or change (admin) the timezones !alltime uses"),
         inline=False
     )
     
     help_embed.add_field(
         name="Server Commands",
-        value="!stats - Show server statistics",
+        value=("!stats - Show server statistics\n"
+               "!stats history [minute|hour|day] - Show member and activity trends\n"
+               "!chartstats - Show chart renderer statistics\n"
+               "!ratestats - Show rate limiter and load shedding statistics\n"
+               "!botmetrics - Show command latency, event loop stalls and storage I/O (admin)"),
         inline=False
     )
     
@@ -154,6 +165,7 @@ async def custom_help(ctx):
         name="Subscription Commands",
         value=("!addsub [name] [amount] [due_date] - Add a subscription\n"
                "!subs - List all active subscriptions\n"
+               "!subchart - Chart your monthly subscription spending\n"
                "!delsub [sub_id] - Delete a subscription by ID\n"
                "!renewsub [sub_id] - Mark subscription as paid and update due date"),
         inline=False
@@ -161,17 +173,50 @@ async def custom_help(ctx):
     
     await ctx.send(embed=help_embed)
 
-async def load_extenstions():           #loads all cogs
-    await bot.load_extension('cogs.subscriptions')
-    await bot.load_extension('cogs.calendar_func')
-    await bot.load_extension('cogs.gif')
-    await bot.load_extension('cogs.roll_dice')
-    await bot.load_extension('cogs.convert_time')
-    await bot.load_extension('cogs.stats')
+async def load_extenstions():           #loads all cogs, convert_time and gif on their first use (LAZY_EXTENSIONS)
+    core = [
+        'cogs.ratelimit',       # first, its global check covers every command
+        'cogs.metrics',         # installs the global before/after invoke hooks
+    ]
+    extensions = [
+        'cogs.subscriptions',
+        'cogs.calendar_func',
+        'cogs.gif',
+        'cogs.roll_dice',
+        'cogs.convert_time',
+        'cogs.stats',
+    ]
+    await load_extensions(bot, profiler, core, extensions)
+
+def create_scheduler():              # the one scheduler shared by every cog through bot.scheduler
+    try:
+        from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+        os.makedirs('data', exist_ok=True)
+        jobstores = {'default': SQLAlchemyJobStore(url=JOBSTORE_URL)}
+    except ImportError:
+        log.warning("SQLAlchemy is not installed, scheduled reminders will not survive a restart")
+        jobstores = {}
+    return AsyncIOScheduler(jobstores=jobstores)
 
 async def main():                   # runs extensions and the bot when called with asyncio.run
     async with bot:                 # this helps awaiting coroutines that are created with load_extensions()
+        bot.scheduler = create_scheduler()
+        # Started here, inside the running loop, exactly once. Paused so the cogs can reconcile
+        # the persisted jobs but none of them runs before the cogs are loaded and the bot is ready
+        bot.scheduler.start(paused=True)
+        await Data.preload_sqlite()
         await load_extenstions()
-        await bot.start(TOKEN)
-
-asyncio.run(main())
+        try:
+            await bot.start(TOKEN)
+        finally:
+            bot.scheduler.shutdown(wait=False)
+            await Data.flush()      # drain pending data writes before the loop closes
+            renderer.close()        # stop the chart worker processes
+
+# Guarded so chart worker processes (spawned, they import this module) don't start the bot
+if __name__ == '__main__':
+    log_listener = logs.setup_logging()     # JSON logs, written by a background thread
+    try:
+        asyncio.run(main())
+    finally:
+        log_listener.stop()                 # flushes the records still queued
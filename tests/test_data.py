@@ -0,0 +1,46 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from cogs import data
+from cogs.data import Data
+
+
+class SqliteImportTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        os.makedirs('data')
+        data.BACKENDS['things'] = 'sqlite'
+        self.restart()
+
+    def tearDown(self):
+        self.restart()
+        data.BACKENDS.pop('things', None)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def restart(self):
+        Data._store.clear()
+        Data._dirty.clear()
+        if Data._sqlite is not None:
+            Data._sqlite.executor.shutdown()
+            Data._sqlite = None
+
+    def test_deleted_records_stay_deleted_after_restart(self):
+        with open('data/things.json', 'w') as f:
+            json.dump({"a": {"id": "a", "name": "old"}}, f)
+
+        self.assertEqual(list(Data.load_data('things')), ['a'])
+        self.assertTrue(os.path.exists('data/things.json.imported'))
+
+        Data.delete_record('things', 'a')
+        self.restart()
+        self.assertEqual(list(Data.load_data('things')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()